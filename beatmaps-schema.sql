@@ -0,0 +1,13 @@
+-- Metadata of every beatmap the bot has looked up. Filled in bulk when the mappool is set so reports don't need the osu! api.
+create table beatmaps (
+    beatmap_id bigint primary key,
+    artist text not null,
+    title text not null,
+    version text not null,
+    stars real,
+    bpm real,
+    ar real,
+    od real,
+    length int,
+    fetched_at timestamptz not null default now()
+);
@@ -0,0 +1,96 @@
+'''Benchmarks render_match_embed() against the lobbies recorded in benchmarks/fixtures.
+
+Run from the repository's root with `python -m benchmarks.bench_render`.
+Save a baseline before a change with `--save baseline.json` and check for regressions after with `--compare baseline.json`.
+More fixtures can be recorded from real matches with `!fixture <match_id> <description>` in #referee.'''
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from os import listdir, path
+
+from match_embed import render_match_embed
+
+fixtures_dir = path.join(path.dirname(__file__), 'fixtures')
+
+
+def load_fixture(filename):
+    with open(path.join(fixtures_dir, filename), 'r') as f:
+        fixture = json.load(f)
+    # JSON only has string keys
+    fixture['pool'] = {int(key): value for key, value in fixture['pool'].items()}
+    fixture['beatmaps'] = {int(key): value for key, value in fixture['beatmaps'].items()}
+    return fixture
+
+
+def render(fixture):
+    return render_match_embed(fixture['match_id'], fixture['sheet'], fixture['lobby'], fixture['pool'], fixture['players'],
+                              fixture['users'], fixture['beatmaps'], fixture['referees'], fixture['tourney_round'],
+                              fixture['schedule_entry'], fixture['reporter'])
+
+
+def bench(fixture, iterations):
+    render(fixture)  # Warm up
+
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter_ns()
+        render(fixture)
+        timings.append(time.perf_counter_ns() - start)
+    timings.sort()
+
+    # Keep the embed alive so what it holds on to shows up in the second snapshot
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    embed = render(fixture)
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = [stat for stat in after.compare_to(before, 'filename') if stat.size_diff > 0]
+    del embed
+
+    return {
+        'mean_us': sum(timings) / len(timings) / 1000,
+        'p95_us': timings[int(len(timings) * 0.95)] / 1000,
+        'peak_kib': peak / 1024,
+        'retained_kib': sum(stat.size_diff for stat in allocated) / 1024,
+        'retained_blocks': sum(stat.count_diff for stat in allocated),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--save', help='write the results to this file to compare against later')
+    parser.add_argument('--compare', help='fail if any fixture is slower than the results in this file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='fraction slower than the baseline that is still a pass')
+    args = parser.parse_args()
+
+    results = {}
+    print(f'{"fixture":<28}{"games":>6}{"mean µs":>10}{"p95 µs":>10}{"peak KiB":>10}{"kept KiB":>10}{"blocks":>8}')
+    for filename in sorted(f for f in listdir(fixtures_dir) if f.endswith('.json')):
+        fixture = load_fixture(filename)
+        result = results[filename] = bench(fixture, args.iterations)
+        print(f'{filename[:-5]:<28}{len(fixture["lobby"]["games"]):>6}{result["mean_us"]:>10.1f}{result["p95_us"]:>10.1f}'
+              f'{result["peak_kib"]:>10.1f}{result["retained_kib"]:>10.1f}{result["retained_blocks"]:>8}')
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = [f'{name}: {result["mean_us"]:.1f}µs vs {baseline[name]["mean_us"]:.1f}µs'
+                       for name, result in results.items()
+                       if name in baseline and result['mean_us'] > baseline[name]['mean_us'] * (1 + args.tolerance)]
+        if regressions:
+            print('Regressions:\n' + '\n'.join(regressions))
+            sys.exit(1)
+        print('No regressions')
+
+
+if __name__ == '__main__':
+    main()
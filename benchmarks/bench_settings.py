@@ -0,0 +1,62 @@
+'''Benchmarks get_setting() against parsing the settings file on every call like it used to.
+
+Run from the repository's root with `python -m benchmarks.bench_settings`.
+Uses settings_template.jsonc with its comments stripped so it doesn't need a real settings file.'''
+import argparse
+import json
+import re
+import tempfile
+import time
+from os import path
+
+import utility_funcs
+from utility_funcs import get_setting
+
+template = path.join(path.dirname(path.dirname(__file__)), 'settings_template.jsonc')
+
+# The lookups made most often: the twitch loop, amplifier dropdowns and match reports
+lookups = [('twitch', 'active'), ('amplifiers', 'week_number'), ('match-result-posting', None)]
+
+
+def parse_every_call(category, setting=None):
+    '''get_setting() as it was before settings were kept in memory.'''
+    with open(utility_funcs.settings_file, 'r') as f:
+        data = json.load(f)
+    category = data[category]
+    if not setting:
+        return category
+    return category['exposed_settings'][setting] if ('exposed_settings' in category and setting in category['exposed_settings']) else category[setting]
+
+
+def bench(function, iterations):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter_ns()
+        for category, setting in lookups:
+            function(category, setting)
+        timings.append((time.perf_counter_ns() - start) / len(lookups))
+    timings.sort()
+    return sum(timings) / len(timings) / 1000, timings[int(len(timings) * 0.95)] / 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=5000)
+    args = parser.parse_args()
+
+    with open(template, 'r') as f:
+        settings = re.sub(r'^\s*//.*$', '', f.read(), flags=re.MULTILINE)
+    with tempfile.TemporaryDirectory() as directory:
+        utility_funcs.settings_file = path.join(directory, 'settings.jsonc')
+        with open(utility_funcs.settings_file, 'w') as f:
+            f.write(settings)
+
+        print(f'{"":<20}{"mean µs":>10}{"p95 µs":>10}')
+        results = {'parse every call': bench(parse_every_call, args.iterations), 'get_setting': bench(get_setting, args.iterations)}
+        for name, (mean, p95) in results.items():
+            print(f'{name:<20}{mean:>10.2f}{p95:>10.2f}')
+        print(f'{results["parse every call"][0] / results["get_setting"][0]:.0f}x faster')
+
+
+if __name__ == '__main__':
+    main()
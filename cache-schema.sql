@@ -0,0 +1,8 @@
+-- Backing table for the TTLCaches in cache.py. Lets the bot restart mid-bracket without a cold cache.
+create table api_cache (
+    cache_name text,
+    key text,
+    value jsonb not null,
+    expires_at timestamptz not null,
+    primary key (cache_name, key)
+);
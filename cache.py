@@ -0,0 +1,105 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+
+_missing = object()
+
+
+class TTLCache:
+    '''A size capped LRU cache where every entry also expires `ttl` seconds after being set.
+    Once attached to a connection pool with load(), entries are also saved to the api_cache table (see cache-schema.sql)
+    so a restart starts with a warm cache. They're saved `save_delay` seconds after being set, along with everything else
+    set by then, in one request. Failing to save them is counted and passed to on_error so the cache is never less
+    available than what it fronts.'''
+    save_delay = 1
+
+    def __init__(self, name, maxsize=1024, ttl=60*60*24, on_error=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_error = on_error
+        self.hits = 0
+        self.misses = 0
+        self.write_errors = 0
+        self._entries = OrderedDict()
+        self._pool = None
+        # Key to (value, expiry) of entries that haven't been saved yet
+        self._unsaved = {}
+        self._save_task = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        key = str(key)
+        entry = self._entries.get(key, _missing)
+        if entry is _missing or entry[0] < time.time():
+            if entry is not _missing:
+                del self._entries[key]
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def _put(self, key, value, expires):
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def set(self, key, value):
+        key = str(key)
+        expires = time.time() + self.ttl
+        self._put(key, value, expires)
+        if self._pool is None:
+            return
+        self._unsaved[key] = (value, expires)
+        if self._save_task is None:
+            self._save_task = asyncio.create_task(self._save_later())
+
+    async def _save_later(self):
+        await asyncio.sleep(self.save_delay)
+        self._save_task = None
+        await self.save()
+
+    async def save(self):
+        '''Saves every entry set since the last save now.'''
+        unsaved, self._unsaved = self._unsaved, {}
+        if not unsaved:
+            return
+        try:
+            async with self._pool.acquire() as conn:
+                await conn.executemany('''insert into api_cache values ($1, $2, $3, to_timestamp($4))
+                                          on conflict (cache_name, key) do update set value=excluded.value, expires_at=excluded.expires_at;''',
+                                       [(self.name, key, json.dumps(value), expires) for key, (value, expires) in unsaved.items()])
+        except Exception:
+            self.write_errors += len(unsaved)
+            if self.on_error is not None:
+                await self.on_error()
+
+    async def get_or_fetch(self, key, fetch):
+        '''Returns the cached value for key, otherwise awaits fetch() and caches what it returns.'''
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = await fetch()
+            self.set(key, value)
+        return value
+
+    async def load(self, pool):
+        '''Attaches the cache to a connection pool and fills it with any unexpired persisted entries.'''
+        self._pool = pool
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('''delete from api_cache where cache_name=$1 and expires_at < now();''', self.name)
+                records = await conn.fetch('''select key, value, extract(epoch from expires_at) as expires from api_cache
+                                              where cache_name=$1 order by expires_at desc limit $2;''', self.name, self.maxsize)
+        # Oldest first so the most recently set entries end up as the most recently used
+        for record in reversed(records):
+            self._put(record['key'], json.loads(record['value']), float(record['expires']))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        return f'{len(self)}/{self.maxsize} entries, {self.hits} hits, {self.misses} misses ({hit_rate:.0%}), {self.write_errors} failed writes'
@@ -5,6 +5,7 @@ import discord
 from discord.app_commands import MissingPermissions
 from discord.ext import commands
 
+from metrics import registry
 from utility_funcs import get_setting, res_cog
 
 
@@ -23,7 +24,8 @@ class ActiveAmplifierDropdown(discord.ui.Select):
         super().__init__(placeholder='Pick one active amplifier...', min_values=1, max_values=1, options=options, custom_id='active-amplifier-select-persistent')
 
     async def callback(self, interaction: discord.Interaction):
-        await shared_callback(self, interaction, AmplifierEnum.ACTIVE)
+        with registry.time('anzt_interaction_seconds', kind='component', name='active-amplifier-select'):
+            await shared_callback(self, interaction, AmplifierEnum.ACTIVE)
 
 
 class PassiveAmplifierDropdown(discord.ui.Select):
@@ -36,7 +38,8 @@ class PassiveAmplifierDropdown(discord.ui.Select):
         super().__init__(placeholder='Pick one passive amplifier...', min_values=1, max_values=1, options=options, custom_id='passive-amplifier-select-persistent')
 
     async def callback(self, interaction: discord.Interaction):
-        await shared_callback(self, interaction, AmplifierEnum.PASSIVE)
+        with registry.time('anzt_interaction_seconds', kind='component', name='passive-amplifier-select'):
+            await shared_callback(self, interaction, AmplifierEnum.PASSIVE)
 
 
 async def shared_callback(self, interaction: discord.Interaction, amplifier_type: AmplifierEnum):
@@ -54,13 +54,17 @@ class ErrorReportingCog(commands.Cog):
         output = f'{self.diony}\n\nThere was an error while processing a(n) `{event}` event:``````'
         await self.add_traceback(output)
 
-    async def add_traceback(self, preamble, error=None):
-        """Replaces empty code blocks with a code block containing the current traceback.
+    async def stall_report(self, seconds, stack):
+        output = f'{self.diony}\n\nThe event loop was blocked for {seconds:.2f}s. It was stuck in (most recent call first):``````'
+        await self.add_traceback(output, tb=stack)
+
+    async def add_traceback(self, preamble, error=None, tb=None):
+        """Replaces empty code blocks with a code block containing the current traceback, or tb if it's given.
         If the full traceback does not fit within discord's per-message character limit,
         the full traceback is included as a file attached to the message."""
-        if error is not None:
+        if tb is None and error is not None:
             tb = "".join(traceback.format_exception(type(error), error, error.__traceback__))
-        else:
+        elif tb is None:
             tb = "".join(traceback.format_exception(*sys.exc_info()))
 
         # Add the first x characters of the traceback to the output up to the 2000 discord character limit
@@ -1,23 +1,135 @@
+import asyncio
+import json
 import re
+import time
+from io import StringIO
 
 import discord
-from discord.ext import commands
+from discord import File
+from discord.ext import commands, tasks
 from discord.ext.commands.converter import MessageConverter
 from discord.ext.commands.errors import MessageNotFound
 from gspread.exceptions import APIError
-from utility_funcs import get_setting, is_channel, request, res_cog, url_to_id
+from match_embed import ReportError, filter_games, render_match_embed, required_lookups
+from utility_funcs import gather_limited, get_exposed_settings, get_setting, is_channel, res_cog, sheet_range, url_to_id
 
 
 class MatchResultPostingCog(commands.Cog):
     delete_delay = 10
     match_id_format = '[0-9]+'
     trigger = re.compile(f'^!{match_id_format}$', re.IGNORECASE)
-    userID_username_cache = {}
-    bmapID_json_cache = {}
-    username_flag_cache = {}
+    # Maximum number of osu! api requests a single report will have in flight at once
+    api_concurrency = 8
+    # Exposed settings that aren't a reference to a cell on a match's tab
+    non_cell_settings = ['tourney_round', 'pool_round', 'sheet_url', 'sheet_tab_name']
+    # Range of the schedule tab that holds one match per row, starting with the match id
+    schedule_range = 'B5:I500'
+    # Minimum number of seconds between on demand schedule reloads caused by unknown match ids
+    schedule_reload_cooldown = 30
+    # Number of matches !reportround builds at once, how often it updates its progress message
+    # and how far back it looks in #match-results for matches that have already been posted
+    report_concurrency = 3
+    progress_interval = 3
+    posted_history_limit = 200
+    # Seconds between polls of a lobby being reported live, and how long without a new game before giving up on it
+    live_poll_interval = 30
+    live_idle_timeout = 60*30
 
     def __init__(self, bot):
         self.bot = bot
+        # Match id to the referee, streamer and time of that match on this round's schedule
+        self.schedule = {}
+        self.schedule_loaded_at = 0
+        self.refresh_schedule.start()
+        # Match id to the task keeping that match's result updated. See !live
+        self.live_reports = {}
+
+    def cog_unload(self):
+        self.refresh_schedule.cancel()
+        for task in self.live_reports.values():
+            task.cancel()
+
+    @tasks.loop(minutes=5)
+    async def refresh_schedule(self):
+        try:
+            await self.load_schedule()
+        except Exception:
+            errorcog = self.bot.get_cog('ErrorReportingCog')
+            await errorcog.on_error('anzt.results.schedule')
+
+    @refresh_schedule.before_loop
+    async def before_refresh_schedule(self):
+        await self.bot.wait_until_ready()
+
+    async def load_schedule(self, refresh=False):
+        '''Rebuilds the schedule index from this round's schedule tab. The tab is only downloaded again if the sheet has changed.
+        `refresh` checks whether it has changed right now rather than trusting a check from the last few seconds.'''
+        setts = get_exposed_settings('match-result-posting')
+        sheets = res_cog(self.bot).sheets
+        sh = await sheets.spreadsheet(setts["sheet_url"])
+        rows = (await sheets.values(sh, [sheet_range(setts["sheet_tab_name"], self.schedule_range)], refresh))[0]
+
+        schedule = {}
+        for row in rows:
+            if not row or not row[0]:
+                continue
+            # Trailing empty cells aren't returned by the api
+            row = row + [''] * (8 - len(row))
+            schedule[row[0].upper()] = {'time': row[1], 'referee': row[6], 'streamer': row[7]}
+        self.schedule = schedule
+        self.schedule_loaded_at = time.monotonic()
+
+    async def match_exists(self, match_id):
+        '''Checks the schedule index for a match, reloading the index first if the match isn't in it.'''
+        if match_id in self.schedule:
+            return True
+        if time.monotonic() - self.schedule_loaded_at > self.schedule_reload_cooldown:
+            try:
+                await self.load_schedule(refresh=True)
+            except Exception:
+                # Carry on with the index we've got. The referee's message is already gone so they still need a reply.
+                # Waits out the cooldown before trying again too, rather than failing the same way for every message.
+                self.schedule_loaded_at = time.monotonic()
+                errorcog = self.bot.get_cog('ErrorReportingCog')
+                await errorcog.on_error('anzt.results.schedule')
+        # Don't get in the way of reporting if the schedule couldn't be read at all
+        return match_id in self.schedule or not self.schedule
+
+    async def prefetch_pool(self):
+        '''Saves the metadata of every beatmap in this round's pool so reports don't have to look any of it up.
+        Returns the number of beatmaps in the pool.'''
+        pool, _ = await self.read_sheet(await self.open_sheet(), [])
+        await res_cog(self.bot).osu_beatmaps(list(pool))
+        return len(pool)
+
+    @commands.Cog.listener()
+    async def on_setting_changed(self, category, setting, value):
+        if category == 'match-result-posting' and setting in ['sheet_url', 'sheet_tab_name']:
+            await self.load_schedule()
+        if category == 'match-result-posting' and setting in ['sheet_url', 'pool_round']:
+            try:
+                await self.prefetch_pool()
+            except ReportError:
+                # The new sheet or round might not have a pool on it yet. !prefetchpool can be used once it does.
+                pass
+
+    @commands.command()
+    @is_channel('referee', 'match-results')
+    async def prefetchpool(self, ctx):
+        await ctx.message.delete()
+        try:
+            count = await self.prefetch_pool()
+        except ReportError as e:
+            await ctx.send(f'{ctx.author.mention} {e}', delete_after=self.delete_delay)
+            return
+        await ctx.send(f'{ctx.author.mention} Saved {count} beatmaps from the pool.', delete_after=self.delete_delay)
+
+    @commands.command()
+    @is_channel('referee', 'match-results')
+    async def refreshschedule(self, ctx):
+        await ctx.message.delete()
+        await self.load_schedule(refresh=True)
+        await ctx.send(f'{ctx.author.mention} Found {len(self.schedule)} matches on the schedule.', delete_after=self.delete_delay)
 
     @commands.Cog.listener()
     async def on_message(self, message):
@@ -28,7 +140,11 @@ class MatchResultPostingCog(commands.Cog):
             if re.match(self.trigger, message.content):
                 async with message.channel.typing():
                     await message.delete()
-                    await self.post_result(message, message.content.lstrip('!').upper())
+                    match_id = message.content.lstrip('!').upper()
+                    if not await self.match_exists(match_id):
+                        await message.channel.send(f'{message.author.mention} Couldn\'t find match {match_id} on the schedule.', delete_after=self.delete_delay)
+                        return
+                    await self.post_result(message, match_id)
 
     @commands.command(aliases=['del', 'undo'])
     @is_channel('match-results')
@@ -44,6 +160,15 @@ class MatchResultPostingCog(commands.Cog):
     async def edit(self, ctx, match_id, oldmessage):
         await ctx.message.delete()
 
+        # Check if match_id is valid
+        if not re.match(self.match_id_format, match_id):
+            await ctx.send(f'{ctx.author.mention} That isn\'t a valid match id.', delete_after=self.delete_delay)
+            return
+        match_id = match_id.upper()
+        if not await self.match_exists(match_id):
+            await ctx.send(f'{ctx.author.mention} Couldn\'t find match {match_id} on the schedule.', delete_after=self.delete_delay)
+            return
+
         # Find the message to edit
         try:
             oldmessage = await MessageConverter().convert(ctx, oldmessage)
@@ -56,187 +181,285 @@ class MatchResultPostingCog(commands.Cog):
             await ctx.send(f'{ctx.author.mention} I didn\'t post that message. I can\'t edit it.', delete_after=self.delete_delay)
             return
 
-        # Check if match_id is valid
-        if not re.match(self.match_id_format, match_id):
-            await ctx.send(f'{ctx.author.mention} That isn\'t a valid match id.', delete_after=self.delete_delay)
-            return
-
-        await self.post_result(ctx.message, match_id.upper(), oldmessage)
+        await self.post_result(ctx.message, match_id, oldmessage)
 
-    async def post_result(self, message, match_id, oldmessage=None):
-        async with message.channel.typing():
-            setts = get_setting('match-result-posting')
-            referees = setts['referees']
-            setts = setts['exposed_settings']
-            apiKey = get_setting('osu', 'apikey')
-
-            # Get spreadsheet from google sheets
-            agc = await res_cog(self.bot).agc()
-            try:
-                sh = await agc.open_by_url(setts["sheet_url"])
-            except APIError as e:
-                if e.args[0]['status'] == 'PERMISSION_DENIED':
-                    await message.channel.send(f'{message.author.mention} I don\'t have permission to view that sheet. Share it with `anzt-bot@anzt-bot.iam.gserviceaccount.com` to give me access.', delete_after=self.delete_delay*2)
+    @commands.command()
+    @is_channel('referee')
+    @commands.max_concurrency(1)
+    async def reportround(self, ctx, mode=None):
+        '''Reports every match on the schedule that has an mp link but hasn't been posted yet. Use `!reportround dry` to only list them.'''
+        await ctx.message.delete()
+        dry_run = mode == 'dry'
+        async with ctx.typing():
+            resultchannel = discord.utils.get(ctx.guild.channels, name='match-results')
+            if resultchannel is None:
+                await ctx.send(f'{ctx.author.mention} Couldn\'t find a channel named `match-results` in this server to post results to', delete_after=self.delete_delay)
                 return
 
-            ws = await sh.worksheet(match_id)
+            await self.load_schedule()
+            # Anything the bot has already posted this round doesn't need reporting again
+            posted = set()
+            async for message in resultchannel.history(limit=self.posted_history_limit):
+                if message.author == self.bot.user and message.embeds and message.embeds[0].title:
+                    posted.add(message.embeds[0].title.replace('Match ID: ', ''))
 
-            # Get lobby id from sheet
             try:
-                urlcell = await ws.acell('G4')
-                lobby_id = url_to_id(urlcell.value)
-            except (SyntaxError, IndexError):
-                await message.channel.send(f'{message.author.mention} Couldn\'t find a valid mp link on the sheet for match: {match_id}', delete_after=self.delete_delay)
+                sh = await self.open_sheet()
+                # Matches can be on the schedule before their tab has been made
+                tabs = {ws.title for ws in await sh.worksheets()}
+                # The schedule index is in the order of the sheet's rows
+                match_ids = [match_id for match_id in self.schedule if match_id not in posted and match_id in tabs]
+                pool, sheets = await self.read_sheet(sh, match_ids)
+            except ReportError as e:
+                await ctx.send(f'{ctx.author.mention} {e}', delete_after=self.delete_delay)
                 return
+            match_ids = [match_id for match_id in match_ids if sheets[match_id]['lobby_id'] is not None]
 
-            # Get lobby info with osu api
-            lobbyjson = await request(f'https://osu.ppy.sh/api/get_match?k={apiKey}&mp={lobby_id}', self.bot)
-            if lobbyjson['match'] == 0:
-                await message.channel.send(f'{message.author.mention} Mp link (https://osu.ppy.sh/mp/{lobby_id}) returned no results for match: {match_id}', delete_after=self.delete_delay)
-                return
-            # elif lobbyjson['match']['end_time'] is None:
-            #     await message.channel.send(f'{message.author.mention} Mp link (https://osu.ppy.sh/mp/{lobby_id}) looks to be incomplete. Use !mp close', delete_after=self.delete_delay)
-            #     return
-
-            # Get the values of all exposed settings except the first 4 which aren't sheet references. Refer to settings_template.json.
-            sheet_references = list(setts.values())[4:]
-            data = await ws.batch_get(sheet_references)
-            # Unwrap the double nested list that is returned but keep empty cells.
-            data = [i[0][0] if i != [] else i for i in data]
-            # , 'ban2': data[4][0:3], 'roll': data[6]
-            # , 'ban2': data[10][0:3], 'roll': data[12]
-            p1 = {'username': data[1], 'score': data[2], 'ban1': data[3][0:3], 'ban2': data[4][0:3], 'protect1': data[6][0:3]}
-            p2 = {'username': data[8], 'score': data[9], 'ban1': data[10][0:3], 'ban2': data[11][0:3], 'protect1': data[13][0:3]}
-            if [] in p1.values() or [] in p2.values():
-                await message.channel.send(f'{message.author.mention} Sheet is missing one or all of player\'s '
-                                           f'usernames, scores, bans or rolls.', delete_after=self.delete_delay)
+            if dry_run or not match_ids:
+                listing = ', '.join(match_ids) if match_ids else 'nothing'
+                await ctx.send(f'{ctx.author.mention} {len(posted)} matches already posted. Would report: {listing}')
                 return
 
-            # Used to line up the scores horizontally by left justifying the username to this amount
-            longest_name_len = len(max([p1['username'], p2['username']], key=len))
-            # Highlight who the winner was using bold and an emoji
-            if p1['score'] > p2['score']:
-                p1['score'] = f'**{p1["score"]}** :trophy:'
-            elif p1['score'] < p2['score']:
-                p2['score'] = f'**{p2["score"]}** :trophy:'
-
-            # Retreive player's flags from api or cache
-            # Duplicate code, I know
-            if p1['username'] not in self.username_flag_cache.keys():
-                json = await request(f'https://osu.ppy.sh/api/get_user?k={apiKey}&u={p1["username"]}&m=0&type=string', self.bot)
-                flag = json[0]['country'].lower()
-                self.username_flag_cache[p1['username']] = flag
-            else:
-                flag = self.username_flag_cache[p1['username']]
-            p1['flag'] = flag
+            progress = await ctx.send(f'Reporting {len(match_ids)} matches...')
+            # Every match shares the same pool so look its beatmaps up once instead of once per match
+            await res_cog(self.bot).osu_beatmaps(list(pool))
 
-            if p2['username'] not in self.username_flag_cache.keys():
-                json = await request(f'https://osu.ppy.sh/api/get_user?k={apiKey}&u={p2["username"]}&m=0&type=string', self.bot)
-                flag = json[0]['country'].lower()
-                self.username_flag_cache[p2['username']] = flag
-            else:
-                flag = self.username_flag_cache[p2['username']]
-            p2['flag'] = flag
-
-            # Get TB bans, but only if they are present
-            p1_tb_ban = data[5][0:3]
-            p2_tb_ban = data[11][0:3]
-            # Check if either cell is empty. Represented by either "TB0" or [].
-            if any(x in [p1_tb_ban, p2_tb_ban] for x in ['TB0', []]):
-                p1_tb_ban = p2_tb_ban = ''
-            else:
-                p1_tb_ban = ', ' + p1_tb_ban
-                p2_tb_ban = ', ' + p2_tb_ban
-
-            # Construct the embed
-            description = (f':flag_{p1["flag"]}: `{p1["username"].ljust(longest_name_len)} -` {p1["score"]}\n'
-                           f'Bans: {p1["ban1"]}, {p1["ban2"]} - Protects: {p1["protect1"]}\n'
-                           f':flag_{p2["flag"]}: `{p2["username"].ljust(longest_name_len)} -` {p2["score"]}\n'
-                           f'Bans: {p2["ban1"]}, {p2["ban2"]} - Protects: {p2["protect1"]}')
-            embed = discord.Embed(title=f'Match ID: {match_id}', description=description, color=0xe47607)
-            embed.set_author(name=f'{setts["tourney_round"]}: ({p1["username"]}) vs ({p2["username"]})',
-                             url=f'https://osu.ppy.sh/mp/{lobby_id}')
-
-            # Add streamer and referee to footer
-            ws = await sh.worksheet(setts["sheet_tab_name"])
-            schedule_batch = (await ws.batch_get(['B5:I500']))[0]
-            referee = ''
-            streamer = ''
-            reporter = message.author.display_name
-            for row in schedule_batch:
-                if row[0] == match_id:
-                    try:
-                        referee = row[6]
-                        streamer = row[7]
-                    except IndexError:
-                        pass
-                    break
+            completed = 0
 
-            footer = f'Refereed by {referee}' if referee else f'Reported by {reporter}'
-            footer += f' - Streamed by {streamer}' if streamer else ''
-            embed.set_footer(text=footer)
+            async def report(match_id):
+                nonlocal completed
+                try:
+                    return await self.build_report(match_id, sheets[match_id], pool, ctx.author.display_name)
+                except ReportError as e:
+                    return e
+                except Exception as e:
+                    # One broken match shouldn't stop the rest from being posted
+                    errorcog = self.bot.get_cog('ErrorReportingCog')
+                    await errorcog.on_error('anzt.results.reportround')
+                    return e
+                finally:
+                    completed += 1
+                    if completed % self.progress_interval == 0:
+                        await progress.edit(content=f'Reporting {len(match_ids)} matches... {completed}/{len(match_ids)}')
+            results = await gather_limited([report(match_id) for match_id in match_ids], self.report_concurrency)
+
+            # Reports are built concurrently but posted in schedule order
+            failures = []
+            for match_id, result in zip(match_ids, results):
+                if isinstance(result, ReportError):
+                    failures.append(f'{match_id}: {result}')
+                elif isinstance(result, Exception):
+                    failures.append(f'{match_id}: Something went wrong ({type(result).__name__}). It\'s been reported.')
+                else:
+                    await resultchannel.send(embed=result)
+            summary = f'Reported {len(match_ids) - len(failures)}/{len(match_ids)} matches.'
+            if failures:
+                summary += ' Failed:```\n' + '\n'.join(failures) + '```'
+            await progress.edit(content=f'{ctx.author.mention} {summary}')
+
+    @commands.command()
+    @is_channel('referee')
+    async def live(self, ctx, match_id):
+        '''Posts a match's result while it's still being played and keeps it updated until the lobby closes.'''
+        await ctx.message.delete()
+        match_id = match_id.upper()
+        if match_id in self.live_reports:
+            await ctx.send(f'{ctx.author.mention} Match {match_id} is already being updated live.', delete_after=self.delete_delay)
+            return
+        if not await self.match_exists(match_id):
+            await ctx.send(f'{ctx.author.mention} Couldn\'t find match {match_id} on the schedule.', delete_after=self.delete_delay)
+            return
+        resultchannel = discord.utils.get(ctx.guild.channels, name='match-results')
+        if resultchannel is None:
+            await ctx.send(f'{ctx.author.mention} Couldn\'t find a channel named `match-results` in this server to post result to', delete_after=self.delete_delay)
+            return
+
+        task = asyncio.create_task(self.live_report(ctx, match_id, resultchannel))
+        self.live_reports[match_id] = task
+        task.add_done_callback(lambda _: self.live_reports.pop(match_id, None))
+
+    async def live_report(self, ctx, match_id, resultchannel):
+        reporter = ctx.author.display_name
+        state = self.new_report_state()
+        try:
+            sh = await self.open_sheet()
+            pool, sheets = await self.read_sheet(sh, [match_id])
+            embed = await self.build_report(match_id, sheets[match_id], pool, reporter, state=state, live=True)
+            message = await resultchannel.send(embed=embed)
+            await ctx.send(f'{ctx.author.mention} Posted match {match_id}. I\'ll keep it updated until the lobby closes.', delete_after=self.delete_delay)
+
+            rendered = embed.to_dict()
+            last_new_game = time.monotonic()
+            while time.monotonic() - last_new_game < self.live_idle_timeout:
+                await asyncio.sleep(self.live_poll_interval)
+                seen_games = len(state['games'])
+                lobbyjson = await self.get_lobby(match_id, sheets[match_id]['lobby_id'])
+                finished = lobbyjson['match']['end_time'] is not None
+                if finished:
+                    # Read the sheet one last time for the final score
+                    pool, sheets = await self.read_sheet(sh, [match_id])
+                embed = await self.build_report(match_id, sheets[match_id], pool, reporter, lobbyjson, state, live=not finished)
+                if len(state['games']) > seen_games:
+                    last_new_game = time.monotonic()
+                # Don't bother discord if nothing has changed
+                if embed.to_dict() != rendered:
+                    await message.edit(content='', embed=embed)
+                    rendered = embed.to_dict()
+                if finished:
+                    break
+            else:
+                await ctx.send(f'{ctx.author.mention} Stopped live reporting {match_id} after {self.live_idle_timeout // 60} minutes '
+                               'without a new game. Report it again once the lobby closes.')
+        except ReportError as e:
+            await ctx.send(f'{ctx.author.mention} Stopped updating match {match_id}: {e}', delete_after=self.delete_delay)
+        except Exception:
+            errorcog = self.bot.get_cog('ErrorReportingCog')
+            await errorcog.on_error('anzt.results.live')
+            await ctx.send(f'{ctx.author.mention} Something went wrong updating match {match_id} so I\'ve stopped. It\'s been reported.',
+                           delete_after=self.delete_delay)
 
-            # Construct the fields within the embed, displaying each pick and score differences
-            firstpick = data[0]
-            if firstpick not in [p1['username'], p2['username']]:
-                await message.channel.send(f'{message.author.mention} Failed to find who picked first by looking at the'
-                                           f'sheet for match: {match_id}', delete_after=self.delete_delay)
+    @commands.command()
+    @is_channel('referee')
+    @commands.has_permissions(administrator=True)
+    async def fixture(self, ctx, match_id, *, description=''):
+        '''Records everything a match's report is rendered from as a benchmark fixture. See benchmarks/bench_render.py'''
+        await ctx.message.delete()
+        match_id = match_id.upper()
+        setts = get_setting('match-result-posting')
+        state = self.new_report_state()
+        async with ctx.typing():
+            try:
+                sh = await self.open_sheet()
+                pool, sheets = await self.read_sheet(sh, [match_id])
+                lobbyjson = await self.get_lobby(match_id, sheets[match_id]['lobby_id'])
+                await self.build_report(match_id, sheets[match_id], pool, ctx.author.display_name, lobbyjson, state)
+            except ReportError as e:
+                await ctx.send(f'{ctx.author.mention} {e}', delete_after=self.delete_delay)
                 return
-            orange = ':small_orange_diamond:'
-            blue = ':small_blue_diamond:'
-            tiebreaker = ':diamond_shape_with_a_dot_inside:'
-
-            # Get the mappool
-            ws = await sh.worksheet('Mappool')
-            poolRound = setts['pool_round']
-            cells = f'D{3+25*poolRound}:F{2+25*(poolRound+1)}'
-            poolbatch = (await ws.batch_get([cells]))[0]
-            pool = {}
-            for row in poolbatch:
-                pool[int(row[2])] = row[0]
-
-            # Only look at games that used a beatmap from the mappool and were not aborted
-            filteredgames = [game for game in lobbyjson['games'] if game['end_time'] is not None and int(game['beatmap_id']) in pool]
-            for i, game in enumerate(filteredgames):
-                emote = orange if i % 2 == 0 else blue
-                # Alternate players starting from whoever the sheet says had first pick
-                picker = p1['username'] if (i % 2 == 0 if firstpick == p1['username'] else i % 2 != 0) else p2['username']
-                bmapID = int(game['beatmap_id'])
-                # Retreive beatmap information from osu api or cache
-                if bmapID not in self.bmapID_json_cache.keys():
-                    bmapJson = await request(f'https://osu.ppy.sh/api/get_beatmaps?k={apiKey}&b={bmapID}', self.bot)
-                    bmapJson = bmapJson[0]
-                    self.bmapID_json_cache[bmapID] = bmapJson
-                else:
-                    bmapJson = self.bmapID_json_cache[bmapID]
-                bmapFormatted = f"{bmapJson['artist']} - {bmapJson['title']} [{bmapJson['version']}]"
-
-                # Filter out scores made by referees
-                scores = [score for score in game['scores'] if int(score['user_id']) not in referees]
-                scores.sort(key=lambda score: int(score['score']), reverse=True)
-                # Retreive winner's username from osu api or cache
-                if scores[0]['user_id'] not in self.userID_username_cache.keys():
-                    winnerjson = await request(f'https://osu.ppy.sh/api/get_user?k={apiKey}&u={scores[0]["user_id"]}', self.bot)
-                    winner = winnerjson[0]['username']
-                    self.userID_username_cache[scores[0]['user_id']] = winner
-                else:
-                    winner = self.userID_username_cache[scores[0]['user_id']]
 
-                # Check if map was tiebreaker
-                if pool[bmapID].startswith('TB'):
-                    firstline = f'{tiebreaker} **Tiebreaker** [{pool[bmapID]}]'
-                else:
-                    firstline = f'{emote}Pick #{i+1} by __{picker}__ [{pool[bmapID]}]'
-                # One or both players didn't play a map
-                if len(scores) < 2:
-                    # await message.channel.send(f'{message.author.mention} It looks like a score is missing in the {infeng.ordinal(i+1)} mappool map for match: {match_id}', delete_after=self.delete_delay)
-                    embed.add_field(name=firstline,
-                                    value=f'[{bmapFormatted}](https://osu.ppy.sh/b/{bmapID})\n'
-                                    f'__{winner} ({int(scores[0]["score"]):,})__ wins. Other score missing.', inline=False)
-                else:
-                    embed.add_field(name=firstline,
-                                    value=f'[{bmapFormatted}](https://osu.ppy.sh/b/{bmapID})\n'
-                                    f'__{winner} ({int(scores[0]["score"]):,})__ wins by **({int(scores[0]["score"])-int(scores[1]["score"]):,})**', inline=False)
+        fixture = {
+            'description': description,
+            'match_id': match_id,
+            'tourney_round': setts['exposed_settings']['tourney_round'],
+            'referees': setts['referees'],
+            'reporter': ctx.author.display_name,
+            'schedule_entry': self.schedule.get(match_id, {}),
+            'sheet': sheets[match_id],
+            'pool': pool,
+            'lobby': lobbyjson,
+            'players': state['players'],
+            'users': state['users'],
+            'beatmaps': state['beatmaps'],
+        }
+        await ctx.send(f'{ctx.author.mention} Fixture for match {match_id}:',
+                       file=File(fp=StringIO(json.dumps(fixture, indent=1)), filename=f'match-{match_id}.json'))
+
+    def new_report_state(self):
+        return {'games': set(), 'players': {}, 'users': {}, 'beatmaps': {}}
+
+    async def open_sheet(self):
+        setts = get_exposed_settings('match-result-posting')
+        try:
+            return await res_cog(self.bot).sheets.spreadsheet(setts["sheet_url"])
+        except APIError as e:
+            if e.args[0]['status'] == 'PERMISSION_DENIED':
+                raise ReportError('I don\'t have permission to view that sheet. Share it with `anzt-bot@anzt-bot.iam.gserviceaccount.com` to give me access.')
+            raise ReportError('I couldn\'t open the sheet.')
+
+    async def read_sheet(self, sh, match_ids):
+        '''Reads the mappool and what's needed from each match's tab, with every match's cells in one request.
+        The mappool is cached until the sheet changes since it's the same for the whole round.
+        Returns the pool as a dictionary of beatmap id to pick (e.g. NM1) and a dictionary of match id to that match's sheet data.'''
+        setts = get_exposed_settings('match-result-posting')
+        # Every exposed setting that isn't in non_cell_settings is a reference to a cell on the match's tab. Refer to settings_template.json.
+        cell_settings = {name: cell for name, cell in setts.items() if name not in self.non_cell_settings}
+        poolRound = setts['pool_round']
+        ranges = []
+        for match_id in match_ids:
+            ranges += [sheet_range(match_id, 'G4')] + [sheet_range(match_id, cell) for cell in cell_settings.values()]
+        try:
+            pool_rows = (await res_cog(self.bot).sheets.values(sh, [sheet_range('Mappool', f'D{3+25*poolRound}:F{2+25*(poolRound+1)}')]))[0]
+        except APIError:
+            raise ReportError('Couldn\'t read the mappool from the Mappool tab.')
+        try:
+            value_ranges = (await sh.values_batch_get(ranges))['valueRanges'] if ranges else []
+        except APIError:
+            raise ReportError(f'Couldn\'t find a tab on the sheet for match: {", ".join(match_ids)}')
+        value_ranges = [value_range.get('values', []) for value_range in value_ranges]
+
+        pool = {}
+        for row in pool_rows:
+            pool[int(row[2])] = row[0]
+
+        sheets = {}
+        per_match = 1 + len(cell_settings)
+        for i, match_id in enumerate(match_ids):
+            match_ranges = value_ranges[i*per_match:(i+1)*per_match]
+            urlcell = match_ranges[0]
+            # Unwrap the double nested list that is returned for each cell but keep empty cells.
+            data = {name: cell[0][0] if cell != [] else cell for name, cell in zip(cell_settings, match_ranges[1:])}
+            try:
+                lobby_id = url_to_id(urlcell[0][0] if urlcell != [] else None)
+            except (SyntaxError, IndexError):
+                lobby_id = None
+            sheets[match_id] = {'lobby_id': lobby_id, 'data': data}
+        return pool, sheets
+
+    async def get_lobby(self, match_id, lobby_id):
+        '''Returns the get_match json for a match's lobby.'''
+        if lobby_id is None:
+            raise ReportError(f'Couldn\'t find a valid mp link on the sheet for match: {match_id}')
+        lobbyjson = await res_cog(self.bot).osu.v1('get_match', mp=lobby_id)
+        if lobbyjson['match'] == 0:
+            raise ReportError(f'Mp link (https://osu.ppy.sh/mp/{lobby_id}) returned no results for match: {match_id}')
+        # elif lobbyjson['match']['end_time'] is None:
+        #     raise ReportError(f'Mp link (https://osu.ppy.sh/mp/{lobby_id}) looks to be incomplete. Use !mp close')
+        return lobbyjson
+
+    async def build_report(self, match_id, sheet, pool, reporter, lobbyjson=None, state=None, live=False):
+        '''Builds the result embed for a match from its sheet data (see read_sheet) and its osu! lobby.
+        Raises ReportError with a message for the reporter if the match can't be reported.
+
+        `state` holds the games, players, winners and beatmaps already looked up for this match. Passing the same
+        state to repeated calls means only games that weren't seen last time are looked up.
+        When `live` is True, the match score is counted from the lobby rather than read from the sheet.'''
+        setts = get_setting('match-result-posting')
+        referees = setts['referees']
+        if state is None:
+            state = self.new_report_state()
+        if lobbyjson is None:
+            lobbyjson = await self.get_lobby(match_id, sheet['lobby_id'])
+
+        # Retreive player's flags, beatmaps and winner's usernames from api or cache.
+        # Everything not already in state is looked up at once so a cold report takes about one api round trip instead of one per lookup.
+        usernames, userIDs, bmapIDs = required_lookups(sheet, lobbyjson, pool, referees, state['games'])
+        usernames = [username for username in usernames if username not in state['players']]
+        userIDs = [userID for userID in userIDs if userID not in state['users']]
+        bmapIDs = [bmapID for bmapID in bmapIDs if bmapID not in state['beatmaps']]
+        resources = res_cog(self.bot)
+        # Winners and beatmaps are looked up in bulk through api v2. Usernames can only be looked up one at a time on v1.
+        players, users, beatmaps = await asyncio.gather(
+            gather_limited([resources.osu_user(username, type='string') for username in usernames], self.api_concurrency),
+            resources.osu_users(userIDs), resources.osu_beatmaps(bmapIDs))
+        if len(users) < len(userIDs) or len(beatmaps) < len(bmapIDs):
+            raise ReportError(f'Couldn\'t find some of the winners or beatmaps of match {match_id} on the osu! api')
+        state['players'].update(zip(usernames, players))
+        state['users'].update(users)
+        state['beatmaps'].update(beatmaps)
+        state['games'].update(game['game_id'] for game, _ in filter_games(lobbyjson, pool, referees))
+
+        return render_match_embed(match_id, sheet, lobbyjson, pool, state['players'], state['users'], state['beatmaps'], referees,
+                                  setts['exposed_settings']['tourney_round'], self.schedule.get(match_id, {}), reporter, live)
+
+    async def post_result(self, message, match_id, oldmessage=None):
+        async with message.channel.typing():
+            try:
+                sh = await self.open_sheet()
+                pool, sheets = await self.read_sheet(sh, [match_id])
+                embed = await self.build_report(match_id, sheets[match_id], pool, message.author.display_name)
+            except ReportError as e:
+                await message.channel.send(f'{message.author.mention} {e}', delete_after=self.delete_delay)
+                return
 
             # Try to find result channel for this server
             resultchannels = [c for c in message.guild.channels if c.name == 'match-results']
@@ -0,0 +1,104 @@
+import asyncio
+import time
+
+from aiohttp import web
+from discord.ext import commands
+from discord.utils import utcnow
+
+from metrics import registry
+from profiling import LoopWatchdog
+from utility_funcs import get_settings
+
+
+class MetricsCog(commands.Cog):
+    '''Times commands, interactions, discord api requests and the event loop into metrics.registry and serves it
+    to Prometheus. Calls to osu!, twitch, sheets and postgres are timed where they're made.'''
+    # Where Prometheus can scrape from if the metrics settings don't say. Only listens locally by default.
+    host = '127.0.0.1'
+    port = 9464
+    # Seconds between checks of how late the event loop is running
+    lag_interval = 1
+    # Seconds the event loop can be blocked for before the stack blocking it is reported
+    stall_threshold = 1
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.bot.before_invoke(self.before_invoke)
+        self.bot.after_invoke(self.after_invoke)
+
+    async def cog_load(self):
+        # Started first so there's nothing to undo if it can't be. Metrics are still shown by !stats without it.
+        self.runner = await self.serve()
+
+        # Wrap the discord REST client so every request it makes is timed, including waiting out rate limits
+        self.original_request = self.bot.http.request
+        self.bot.http.request = self.timed_request
+
+        self.lag_task = asyncio.create_task(self.measure_loop_lag())
+        self.watchdog = LoopWatchdog(asyncio.get_running_loop(), self.on_stall, self.stall_threshold)
+        self.watchdog.start()
+
+    async def serve(self):
+        '''Starts serving /metrics where the metrics settings say to. Returns the runner to clean up, or None if it's turned off
+        or couldn't be started, e.g. because the port is taken.'''
+        # Optional so settings files from before it was added still work
+        setts = get_settings().get("metrics", {})
+        if setts.get("serve", "Y") != "Y":
+            return None
+        host, port = setts.get("host", self.host), setts.get("port", self.port)
+
+        app = web.Application()
+        app.router.add_get('/metrics', self.serve_metrics)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, host, port).start()
+        except OSError as e:
+            await runner.cleanup()
+            print(f'Not serving metrics, couldn\'t listen on {host}:{port}: {e}')
+            return None
+        return runner
+
+    async def cog_unload(self):
+        self.bot.http.request = self.original_request
+        self.lag_task.cancel()
+        self.watchdog.stop()
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    async def before_invoke(self, ctx):
+        ctx.invoked_at = time.perf_counter()
+
+    async def after_invoke(self, ctx):
+        registry.histogram('anzt_command_seconds', command=ctx.command.qualified_name).observe(
+            time.perf_counter() - ctx.invoked_at, error=ctx.command_failed)
+
+    @commands.Cog.listener()
+    async def on_app_command_completion(self, interaction, command):
+        # Measured from when discord created the interaction, which is what the user waited for
+        registry.histogram('anzt_interaction_seconds', kind='app_command', name=command.qualified_name).observe(
+            (utcnow() - interaction.created_at).total_seconds())
+
+    async def timed_request(self, route, **kwargs):
+        with registry.time('anzt_outbound_seconds', dependency='discord', operation=f'{route.method} {route.path}'):
+            return await self.original_request(route, **kwargs)
+
+    async def measure_loop_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.lag_interval)
+            registry.histogram('anzt_loop_lag_seconds').observe(max(0, loop.time() - start - self.lag_interval))
+
+    async def on_stall(self, seconds, stack):
+        registry.histogram('anzt_loop_stall_seconds').observe(seconds)
+        # Stalls while connecting, before there's anywhere to report them, are only counted
+        if self.bot.is_ready():
+            await self.bot.get_cog('ErrorReportingCog').stall_report(seconds, stack)
+
+    async def serve_metrics(self, request):
+        return web.Response(body=registry.prometheus().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def setup(bot):
+    await bot.add_cog(MetricsCog(bot))
@@ -1,8 +1,13 @@
-from discord import Embed, Member
+from copy import copy
+from io import StringIO
+
+from discord import Embed, File, Member
 from discord.ext import commands
 from discord.ext.commands import MemberConverter, MemberNotFound
 
-from utility_funcs import _get_settings, is_channel, set_exposed_setting
+from metrics import registry
+from profiling import profile
+from utility_funcs import get_exposed_settings, get_settings, is_channel, res_cog, set_exposed_setting
 
 
 class OwnerCog(commands.Cog, command_attrs=dict(hidden=True)):
@@ -18,7 +23,9 @@ class OwnerCog(commands.Cog, command_attrs=dict(hidden=True)):
         await ctx.send('Success', delete_after=self.delete_delay)
 
     async def cog_before_invoke(self, ctx):
-        await ctx.message.delete()
+        # The command being profiled deletes the message itself if it wants to
+        if ctx.command.name != 'profile':
+            await ctx.message.delete()
 
     @commands.Cog.listener()
     async def on_message(self, message):
@@ -85,6 +92,25 @@ class OwnerCog(commands.Cog, command_attrs=dict(hidden=True)):
     async def logout(self, ctx):
         await self.bot.close()
 
+    @commands.command()
+    @commands.is_owner()
+    async def profile(self, ctx, *, command_line):
+        '''Runs a command under a profiler and sends the results, e.g. !profile reportround dry'''
+        message = copy(ctx.message)
+        message.content = f'{ctx.prefix}{command_line}'
+        profiled_ctx = await self.bot.get_context(message)
+        if not profiled_ctx.valid:
+            await ctx.send(f'{ctx.author.mention} `{command_line}` isn\'t a command.', delete_after=self.delete_delay)
+            return
+
+        elapsed, stats, stacks = await profile(self.bot.invoke(profiled_ctx))
+        files = [File(StringIO(stats), 'profile.txt')]
+        if stacks:
+            files.append(File(StringIO(stacks), 'async-stacks.collapsed'))
+        await ctx.send(f'{ctx.author.mention} `{command_line}` took {elapsed:.2f}s. '
+                       'profile.txt is everything that ran on the event loop meanwhile, async-stacks.collapsed is what '
+                       'the command was running or waiting on (for flamegraph.pl or speedscope).', files=files)
+
     @commands.command()
     @commands.has_permissions(administrator=True)
     async def purge(self, ctx, limit: int):
@@ -93,28 +119,46 @@ class OwnerCog(commands.Cog, command_attrs=dict(hidden=True)):
     @commands.command()
     @commands.has_permissions(administrator=True)
     async def settings(self, ctx):
-        data = _get_settings()
-
         description = ''
-        for category in data:
-            if 'exposed_settings' in data[category]:
+        for category, values in get_settings().items():
+            if 'exposed_settings' in values:
                 description += f'**{category}**\n```'
-                for setting in data[category]['exposed_settings']:
-                    description += f'{setting} = {data[category]["exposed_settings"][setting]}\n'
+                for setting, value in values['exposed_settings'].items():
+                    description += f'{setting} = {value}\n'
                 description += '```'
 
         embed = Embed(title='Settings', description=description, color=0xe47607)
         embed.set_footer(text=f'Replying to {ctx.author.display_name}')
         await ctx.send(embed=embed)
 
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def stats(self, ctx):
+        description = ''
+        for section, lines in {**res_cog(self.bot).stats(), **registry.stats()}.items():
+            description += f'**{section}**\n```'
+            description += '\n'.join(lines) if lines else '-'
+            description += '```'
+
+        # Embed descriptions are limited to 4096 characters
+        if len(description) > 4096:
+            await ctx.send(f'{ctx.author.mention} Stats', file=File(StringIO(description), 'stats.md'))
+            return
+        embed = Embed(title='Stats', description=description, color=0xe47607)
+        embed.set_footer(text=f'Replying to {ctx.author.display_name}')
+        await ctx.send(embed=embed)
+
     @commands.command()
     @commands.has_permissions(administrator=True)
     async def set(self, ctx, category, setting, value):
         try:
             if set_exposed_setting(category, setting, value):
+                self.bot.dispatch('setting_changed', category, setting, get_exposed_settings(category)[setting])
                 await ctx.send(f'{ctx.author.mention} Done', delete_after=self.delete_delay)
             else:
                 await ctx.send(f'{ctx.author.mention} That setting couldn\'t be set. It might not exist.', delete_after=self.delete_delay)
+        except ValueError as e:
+            await ctx.send(f'{ctx.author.mention} {setting} {e}.', delete_after=self.delete_delay)
         except Exception:
             await ctx.send(f'{ctx.author.mention} There was an error setting that setting.', delete_after=self.delete_delay)
 
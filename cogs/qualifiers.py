@@ -1,21 +1,63 @@
+import asyncio
+import functools
 import re
 from datetime import date
 from io import StringIO
 
 import discord
-from asyncpg import RaiseError
 from discord import File
 from discord.ext import commands
 from discord.ext.commands import BucketType
+from gspread.utils import a1_to_rowcol
 
+from lobby_embed import embeds_hash, group_by_message, lobbies_query, render_lobby_embed
 from utility_funcs import confirm, get_exposed_settings, is_channel, res_cog
 
 
 class QualifiersCog(commands.Cog):
     spreadsheet_range = re.compile('([a-zA-Z]+)(\\d+):([a-zA-Z]+)(\\d+)')
+    # Seconds to wait after a signup changes before updating the sheet and board, so a rush of them is shown in one go
+    refresh_delay = 2
 
     def __init__(self, bot):
         self.bot = bot
+        # Persistent message id to embeds_hash() of what it was last edited to show
+        self.board_hashes = {}
+        # Channel of the board if it needs updating and whether the ref sheet does. See mark_dirty()
+        self.dirty_board = None
+        self.dirty_sheet = False
+        self.refresh_task = None
+        # (sheet url, tab, output range) to the rows known to have been written there. See update_ref_sheet()
+        self.sheet_rows = {}
+
+    def cog_unload(self):
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+
+    def mark_dirty(self, channel):
+        '''Updates the ref sheet and the board in channel refresh_delay seconds from now, along with any other changes by then.'''
+        self.dirty_board = channel
+        self.dirty_sheet = True
+        if self.refresh_task is None:
+            self.refresh_task = asyncio.create_task(self._refresh_later())
+
+    async def _refresh_later(self):
+        try:
+            # Changes made while updating are picked up by going around again
+            while self.dirty_board is not None or self.dirty_sheet:
+                await asyncio.sleep(self.refresh_delay)
+                channel, sheet = self.dirty_board, self.dirty_sheet
+                self.dirty_board, self.dirty_sheet = None, False
+                try:
+                    if sheet:
+                        await self.update_ref_sheet()
+                    if channel is not None:
+                        await self.update_lobbies(channel)
+                except Exception:
+                    errorcog = self.bot.get_cog('ErrorReportingCog')
+                    await errorcog.on_error('anzt.qualifiers.refresh')
+        finally:
+            self.refresh_task = None
 
     async def _connpool(self):
         return await res_cog(self.bot).connpool()
@@ -33,40 +75,25 @@ class QualifiersCog(commands.Cog):
 
     @commands.command()
     @is_channel('qualifiers')
-    @commands.cooldown(1, 6, BucketType.channel)
+    @commands.cooldown(1, 6, BucketType.user)
     async def lobby(self, ctx, lobby_id: int):
         await ctx.message.delete()
-        id = ctx.author.id
         await ctx.typing()
         async with (await self._connpool()).acquire() as conn:
-            async with conn.transaction():
-                player = await conn.fetchrow('''select * from players where discord_id=$1''', id)
-                if player is None:
-                    await ctx.send(f'{ctx.author.mention} You don\'t appear to be registered for this tourney', delete_after=10)
-                    return
-                lobby = await conn.fetchrow('''select * from lobbies where lobby_id=$1''', lobby_id)
-                if lobby is None:
-                    await ctx.send(f'{ctx.author.mention} I can\'t find a lobby with id {lobby_id}', delete_after=10)
-                    return
-                lobby_signup = await conn.fetchrow('''select * from lobby_signups where osu_id=$1''', player['osu_id'])
-
-                try:
-                    # Signing up to a new lobby
-                    if lobby_signup is None:
-                        await conn.execute('''insert into lobby_signups values ($1, $2)''', player['osu_id'], lobby_id)
-                        await ctx.send(f'{ctx.author.mention} Added you to lobby {lobby_id}', delete_after=10)
-                    # Removing themselves from the lobby they are in
-                    elif lobby_signup['lobby_id'] == lobby_id:
-                        await conn.execute('''delete from lobby_signups where osu_id=$1''', player['osu_id'])
-                        await ctx.send(f'{ctx.author.mention} Removed you from lobby {lobby_id}', delete_after=10)
-                    # Switching lobbies
-                    else:
-                        await conn.execute('''update lobby_signups set lobby_id=$1 where osu_id=$2''', lobby_id, player['osu_id'])
-                        await ctx.send(f'{ctx.author.mention} Switched you to lobby {lobby_id}', delete_after=10)
-                except RaiseError:
-                    await ctx.send(f'{ctx.author.mention} Lobby {lobby_id} is full', delete_after=10)
-        await self.update_ref_sheet()
-        await self.update_lobbies(ctx)
+            # discord_id isn't unique so a discord account linked to more than one player gets the first, like it used to
+            outcome = await conn.fetchval('''select toggle_lobby_signup((select osu_id from players where discord_id=$1 limit 1), $2)''',
+                                          ctx.author.id, lobby_id)
+        responses = {
+            'no_player': 'You don\'t appear to be registered for this tourney',
+            'no_lobby': f'I can\'t find a lobby with id {lobby_id}',
+            'added': f'Added you to lobby {lobby_id}',
+            'removed': f'Removed you from lobby {lobby_id}',
+            'switched': f'Switched you to lobby {lobby_id}',
+            'full': f'Lobby {lobby_id} is full',
+        }
+        await ctx.send(f'{ctx.author.mention} {responses[outcome]}', delete_after=10)
+        if outcome in ['added', 'removed', 'switched']:
+            self.mark_dirty(ctx.channel)
 
     @commands.command()
     @commands.has_permissions(administrator=True)
@@ -74,91 +101,88 @@ class QualifiersCog(commands.Cog):
         await ctx.message.delete()
         await ctx.typing()
 
+        # Writes every row, in case the sheet was changed by hand
+        self.sheet_rows.clear()
         await self.update_ref_sheet()
+        await res_cog(self.bot).sheet_writes.flush()
 
         await ctx.send(f'{ctx.author.mention} Sheet updated.', delete_after=10)
 
     async def update_ref_sheet(self):
         settings = get_exposed_settings("qualifiers")
+        sheets = res_cog(self.bot).sheets
 
-        # Get the order of the lobbies on the sheet
-        agc = await res_cog(self.bot).agc()
-        sh = await agc.open_by_url(settings["sheet_url"])
-        ws = await sh.worksheet(settings["sheet_tab_name"])
+        # Get the order of the lobbies on the sheet. Not read through sheets.values() since the rows written below change the
+        # sheet's version, which would throw the cached range away almost every time anyway.
+        ws = await sheets.worksheet(settings["sheet_url"], settings["sheet_tab_name"])
         lobbies = (await ws.batch_get([settings["info_range"]]))[0]
 
         # Get lobby signups from database
         async with (await self._connpool()).acquire() as conn:
             async with conn.transaction():
-                lobby_signups_raw = await conn.fetch('''select lobby_id, STRING_AGG(osu_username, '||') as players from lobby_signups left join players on lobby_signups.osu_id = players.osu_id group by lobby_id order by lobby_id asc;''')
+                lobby_signups_raw = await conn.fetch('''select lobby_id, STRING_AGG(osu_username, '||' order by osu_username) as players from lobby_signups left join players on lobby_signups.osu_id = players.osu_id group by lobby_id order by lobby_id asc;''')
 
         # Convert to dictionary of lobby id to list of player names
         lobby_signups = {}
         for lobby in lobby_signups_raw:
             lobby_signups[int(lobby['lobby_id'])] = lobby['players'].split('||')
 
-        # Create and fill dictionary of cell updates
-        batch_update_data = []
-        # Figure out where to put data based on setting
+        # Fill every row of the output range, leaving rows and cells without a player empty
         output_range = settings["output_range"]
         result = re.search(self.spreadsheet_range, output_range)
-        start_col = result.group(1)
-        end_col = result.group(3)
-        row = int(result.group(2))
+        first_column, first_row, last_column = result.group(1), int(result.group(2)), result.group(3)
+        width = a1_to_rowcol(f'{last_column}1')[1] - a1_to_rowcol(f'{first_column}1')[1] + 1
+        height = int(result.group(4)) - first_row + 1
+        rows = []
         for lobby in lobbies:
             players = lobby_signups[int(lobby[0])] if int(lobby[0]) in lobby_signups else []
-            batch_update_data.append({'range': f'{start_col}{row}:{end_col}{row}', 'values': [players]})
-            row += 1
-
-        await ws.batch_clear([settings["output_range"]])
-        await ws.batch_update(batch_update_data, value_input_option='RAW')
+            rows.append(players + [''] * (width - len(players)))
+        rows += [[''] * width] * (height - len(rows))
+
+        # Only write the rows that are different to what's been written, or all of them the first time.
+        # Rows are only remembered once they've been written so ones that failed are sent again next time.
+        # Queued so a rush of !lobby commands is written in a few requests rather than going over the sheets quota.
+        key = (settings["sheet_url"], settings["sheet_tab_name"], output_range)
+        written = self.sheet_rows.setdefault(key, [None] * height)
+        for i, row in enumerate(rows[:height]):
+            if row != written[i]:
+                res_cog(self.bot).sheet_writes.update(ws, f'{first_column}{first_row+i}:{last_column}{first_row+i}', [row],
+                                                      on_written=functools.partial(written.__setitem__, i, row))
 
     @commands.command()
     @is_channel('qualifiers')
     @commands.has_permissions(administrator=True)
-    @commands.cooldown(1, 6, BucketType.channel)
+    @commands.cooldown(1, 6, BucketType.user)
     async def signup(self, ctx, osu_username: str, lobby_id: int):
         await ctx.message.delete()
         await ctx.typing()
         async with (await self._connpool()).acquire() as conn:
-            async with conn.transaction():
-                player = await conn.fetchrow('''select * from players where osu_username ilike $1''', osu_username)
-                if player is None:
-                    await ctx.send(f'{ctx.author.mention} Couldn\'t find a user named {osu_username}', delete_after=10)
-                    return
-                lobby = await conn.fetchrow('''select * from lobbies where lobby_id=$1''', lobby_id)
-                if lobby is None:
-                    await ctx.send(f'{ctx.author.mention} I can\'t find a lobby with id {lobby_id}', delete_after=10)
-                    return
-                lobby_signup = await conn.fetchrow('''select * from lobby_signups where osu_id=$1''', player['osu_id'])
-
-                try:
-                    # Signing up to a new lobby
-                    if lobby_signup is None:
-                        await conn.execute('''insert into lobby_signups values ($1, $2)''', player['osu_id'], lobby_id)
-                        await ctx.send(f'{ctx.author.mention} Added {osu_username} to lobby {lobby_id}', delete_after=10)
-                    # Removing them from the lobby they are in
-                    elif lobby_signup['lobby_id'] == lobby_id:
-                        await conn.execute('''delete from lobby_signups where osu_id=$1''', player['osu_id'])
-                        await ctx.send(f'{ctx.author.mention} Removed {osu_username} from lobby {lobby_id}', delete_after=10)
-                    # Switching lobbies
-                    else:
-                        await conn.execute('''update lobby_signups set lobby_id=$1 where osu_id=$2''', lobby_id, player['osu_id'])
-                        await ctx.send(f'{ctx.author.mention} Switched {osu_username} to lobby {lobby_id}', delete_after=10)
-                except RaiseError:
-                    await ctx.send(f'{ctx.author.mention} Lobby {lobby_id} is full', delete_after=10)
-        await self.update_lobbies(ctx)
+            outcome = await conn.fetchval('''select toggle_lobby_signup((select osu_id from players where osu_username ilike $1 limit 1), $2)''',
+                                          osu_username, lobby_id)
+        responses = {
+            'no_player': f'Couldn\'t find a user named {osu_username}',
+            'no_lobby': f'I can\'t find a lobby with id {lobby_id}',
+            'added': f'Added {osu_username} to lobby {lobby_id}',
+            'removed': f'Removed {osu_username} from lobby {lobby_id}',
+            'switched': f'Switched {osu_username} to lobby {lobby_id}',
+            'full': f'Lobby {lobby_id} is full',
+        }
+        await ctx.send(f'{ctx.author.mention} {responses[outcome]}', delete_after=10)
+        if outcome in ['added', 'removed', 'switched']:
+            self.mark_dirty(ctx.channel)
 
     @commands.command()
     @is_channel('qualifiers')
     @commands.has_permissions(administrator=True)
-    async def placeholders(self, ctx):
+    async def placeholders(self, ctx, days_per_message: int = 1):
+        '''Sends the messages the lobbies are listed in. Several days can share a message to make fewer edits, as long as their
+        embeds add up to less than discord's 6000 character limit.'''
         await ctx.typing()
         await ctx.message.delete()
         # remove previous messages
         async with (await self._connpool()).acquire() as conn:
             async with conn.transaction():
-                messages = await conn.fetch('''select message_id from persistent_messages''')
+                messages = await conn.fetch('''select distinct message_id from persistent_messages''')
                 for message in messages:
                     try:
                         i = await ctx.channel.fetch_message(message['message_id'])
@@ -166,21 +190,21 @@ class QualifiersCog(commands.Cog):
                     except discord.NotFound:
                         pass
                 await conn.execute('''delete from persistent_messages''')
+        self.board_hashes.clear()
 
         dates = [date(2023, 1, 19), date(2023, 1, 20), date(2023, 1, 21), date(2023, 1, 22), date(2023, 1, 23)]
         thumbnail_urls = ['https://i.imgur.com/dGHbY0M.png', 'https://i.imgur.com/s1FX0BC.png', 'https://i.imgur.com/HGG8cLc.png', 'https://i.imgur.com/IsZ9i8j.png', 'https://i.imgur.com/xEsJ6If.png']
         ids = []
         # send the placeholder messages
-        for _ in dates:
+        for i in range(0, len(dates), days_per_message):
             message = await ctx.send(embed=discord.Embed(description='placeholder'))
-            ids.append(message.id)
+            ids += [message.id] * len(dates[i:i+days_per_message])
         message = await ctx.send(embed=discord.Embed(description='Use `!lobby #` to sign up for, switch to or leave a lobby E.g. !lobby 5\nAll times are in AEDT (UTC+11) | @Diony anywhere else for bot problems'))
-        ids.append(message.id)
         # store the placeholder messages
         async with (await self._connpool()).acquire() as conn:
             async with conn.transaction():
                 await conn.executemany('''insert into persistent_messages values ($1, $2, $3)''', list(zip(ids, dates, thumbnail_urls)))
-                await conn.execute('''insert into persistent_messages (message_id) values ($1)''', ids[-1])
+                await conn.execute('''insert into persistent_messages (message_id) values ($1)''', message.id)
 
     @commands.command()
     @is_channel('qualifiers')
@@ -188,47 +212,23 @@ class QualifiersCog(commands.Cog):
     async def refresh(self, ctx):
         await ctx.typing()
         await ctx.message.delete()
-        await self.update_lobbies(ctx)
+        # Edits every message, in case one was changed some other way
+        self.board_hashes.clear()
+        await self.update_lobbies(ctx.channel)
 
-    async def update_lobbies(self, ctx):
+    async def update_lobbies(self, channel):
         async with (await self._connpool()).acquire() as conn:
-            async with conn.transaction():
-                messages = await conn.fetch('''select * from persistent_messages;''')
-                lobbies = await conn.fetch('''select * from lobbies;''')
-                signups = await conn.fetch('''select osu_username, lobby_id from players natural join lobby_signups;''')
-                staff = await conn.fetch('''select * from staff''')
+            rows = await conn.fetch(lobbies_query)
         # message records that have a day associated will contain information about lobbies on that day.
-        messages = [message for message in messages if message['day'] is not None]
-        messages.sort(key=lambda x: x['day'])
-        for i in messages:
-            message = await ctx.channel.fetch_message(i['message_id'])
-            lobbies_for_message = [record for record in lobbies if record['time'].date() == i['day']]
-            lobbies_for_message.sort(key=lambda x: x['time'])
-
-            embed = discord.Embed(color=discord.Colour(0x6e95fc))
-            embed.set_thumbnail(url=i['thumbnail_url'])
-            for lobby in lobbies_for_message:
-                players = [record['osu_username'] for record in signups if record['lobby_id'] == lobby['lobby_id']]
-                time = lobby['time']
-                # datetime didn't have an easy way to get lowercase am/pm so I just did it manually
-                timestring = f'{time.hour%12}:{str(time.minute).zfill(2)}{"am" if time.hour < 12 else "pm"}'
-                # uses discord emotes to represent time with an analog clock emote
-                name = f':clock{time.hour%12 if time.hour%12 != 0 else 12}: {timestring}'
-                # either contains the reffs osu name or None if lobby has no reff
-                referee_name = [record['staff_osu_username'] for record in staff if record['staff_osu_id'] == lobby['staff_osu_id']]
-
-                free_spots = 16 - len(players)
-                if free_spots == 0:
-                    emote = ':red_circle:'
-                elif free_spots == 16:
-                    emote = ':orange_circle:'
-                else:
-                    emote = ':green_circle:'
-                playerstring = '    '.join(players) if len(players) > 0 else '-'
-                reff = f' | Reffed by {referee_name[0]}' if referee_name else ''
-                value = f'{emote} **ID: {lobby["lobby_id"]}** | {free_spots} free spots{reff}```{playerstring}```'
-                embed.add_field(name=name, inline=False, value=value)
-            await message.edit(content='', embed=embed)
+        # A signup only changes one or two days so only the messages that would look different are edited.
+        for message_id, days in group_by_message(rows):
+            embeds = [render_lobby_embed(thumbnail_url, lobbies) for thumbnail_url, lobbies in days]
+            digest = embeds_hash(embeds)
+            if self.board_hashes.get(message_id) == digest:
+                continue
+            # Editing a partial message saves fetching it first
+            await channel.get_partial_message(message_id).edit(content='', embeds=embeds)
+            self.board_hashes[message_id] = digest
 
     @commands.command()
     @commands.has_permissions(administrator=True)
@@ -1,46 +1,229 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from os import path
 
 import aiohttp
 import asyncpg
-import gspread_asyncio
 from discord.ext import commands
 from google.oauth2.service_account import Credentials
+
+from cache import TTLCache
+from db import InstrumentedPool
+from metrics import HttpStats
+from sheets import QuotaBackoffClientManager, SheetsCache, SheetWriteQueue
+from osu_api import OsuApiClient
+import utility_funcs
 from utility_funcs import get_setting
 
 
 class ResourcesCog(commands.Cog):
+    # Connections the shared session keeps open in total and to any one host, e.g. osu.ppy.sh
+    http_limit = 50
+    http_limit_per_host = 10
+    # Seconds to cache dns lookups for and to keep idle connections open for
+    dns_ttl = 300
+    keepalive_timeout = 60
+    # Seconds before giving up on a request altogether and on just connecting
+    http_timeout = 30
+    http_connect_timeout = 5
+    # Threads for calls that would block the event loop, like the twitch client. See run_blocking()
+    blocking_threads = 4
 
     def __init__(self, bot):
         self.bot = bot
 
-        self.requests_session = aiohttp.ClientSession()
-        self.agcm = gspread_asyncio.AsyncioGspreadClientManager(self._get_creds)
+        self.executor = ThreadPoolExecutor(max_workers=self.blocking_threads, thread_name_prefix='anzt-blocking')
+        self.http_stats = HttpStats()
+        connector = aiohttp.TCPConnector(limit=self.http_limit, limit_per_host=self.http_limit_per_host,
+                                         ttl_dns_cache=self.dns_ttl, keepalive_timeout=self.keepalive_timeout)
+        timeout = aiohttp.ClientTimeout(total=self.http_timeout, connect=self.http_connect_timeout)
+        self.requests_session = aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                                      trace_configs=[self.http_stats.trace_config()])
+        self.osu = OsuApiClient(self.requests_session)
+        self.agcm = QuotaBackoffClientManager(self._get_creds)
+        self.sheets = SheetsCache(self.agcm, self.executor)
+        self.sheet_writes = SheetWriteQueue(self._sheet_write_error)
+        # Users are re-fetched every few hours so renames and flag changes are picked up
+        self.caches = {
+            'osu_users': TTLCache('osu_users', maxsize=2048, ttl=60*60*6, on_error=self._cache_write_error),
+        }
+        # Beatmap id to its metadata from the beatmaps table. Ranked beatmaps don't change so these never expire.
+        self.beatmaps = {}
+        # Tasks nothing waits on, kept here so they aren't garbage collected before they finish
+        self.background_tasks = set()
+
+    async def cog_load(self):
+        # Created in the background so loading the extension doesn't wait on the database. See connpool()
+        self.pool_task = asyncio.create_task(self._create_pool())
+        self.warm_task = asyncio.create_task(self._warm_caches())
+        utility_funcs.on_settings_write_error = self._settings_write_error
+        utility_funcs.settings_executor = self.executor
 
-    @commands.Cog.listener()
-    async def on_ready(self):
+    async def _create_pool(self):
         setts = get_setting("postgresql")
-        self.connection_pool = await asyncpg.create_pool(database=setts["dbname"],
-                                                         user=setts["dbuser"],
-                                                         password=setts["dbpass"],
-                                                         host=setts["dbhost"],
-                                                         port=setts["dbport"])
+        max_size = setts.get("pool_max_size", 10)
+        pool = await asyncpg.create_pool(database=setts["dbname"],
+                                         user=setts["dbuser"],
+                                         password=setts["dbpass"],
+                                         host=setts["dbhost"],
+                                         port=setts["dbport"],
+                                         min_size=setts.get("pool_min_size", 2),
+                                         max_size=max_size,
+                                         statement_cache_size=setts.get("statement_cache_size", 100),
+                                         max_inactive_connection_lifetime=setts.get("max_inactive_connection_lifetime", 300))
+        return InstrumentedPool(pool, max_size)
+
+    async def _warm_caches(self):
+        '''Loads the caches and stored beatmaps from the database. Kept apart from creating the pool so that a missing
+        table only costs the warm cache, not every database feature.'''
+        try:
+            pool = await self.connpool()
+            for cache in self.caches.values():
+                await cache.load(pool)
+            async with pool.acquire() as conn:
+                records = await conn.fetch('select beatmap_id, artist, title, version, stars, bpm, ar, od, length from beatmaps')
+            for record in records:
+                self.beatmaps[str(record['beatmap_id'])] = {**dict(record), 'beatmap_id': str(record['beatmap_id'])}
+        except Exception:
+            # Give the error reporting cog some time to do what's in it's on_ready listener before it's ready to handle errors
+            await self.bot.wait_until_ready()
+            await asyncio.sleep(1)
+            errorcog = self.bot.get_cog('ErrorReportingCog')
+            await errorcog.on_error('anzt.resources.warm_caches')
+
+    def _pool_failed(self):
+        return self.pool_task.done() and (self.pool_task.cancelled() or self.pool_task.exception() is not None)
 
     def cog_unload(self):
         loop = self.bot.loop
-        loop.create_task(self.connection_pool.close())
+        self.warm_task.cancel()
+        utility_funcs.on_settings_write_error = None
+        utility_funcs.settings_executor = None
+        if not self.pool_task.done():
+            self.pool_task.cancel()
+        elif not self._pool_failed():
+            loop.create_task(self._close_pool())
         loop.create_task(self.requests_session.close())
+        loop.create_task(self.sheet_writes.flush())
+        # Lets calls already running finish in the background
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _close_pool(self):
+        # Cache entries that haven't been saved yet would be lost otherwise
+        for cache in self.caches.values():
+            await cache.save()
+        await self.pool_task.result().close()
+
+    async def _settings_write_error(self):
+        errorcog = self.bot.get_cog('ErrorReportingCog')
+        await errorcog.on_error('anzt.settings.write')
+
+    async def _cache_write_error(self):
+        errorcog = self.bot.get_cog('ErrorReportingCog')
+        await errorcog.on_error('anzt.cache.write')
+
+    async def _sheet_write_error(self):
+        errorcog = self.bot.get_cog('ErrorReportingCog')
+        await errorcog.on_error('anzt.sheets.write')
 
     async def agc(self):
         return await self.agcm.authorize()
 
     async def connpool(self):
-        return self.connection_pool
+        '''Waits for the connection pool to be ready and returns it. If creating it failed, tries again.'''
+        if self._pool_failed():
+            self.pool_task = asyncio.create_task(self._create_pool())
+        # Shielded so a caller being cancelled doesn't cancel creating the pool for everyone
+        return await asyncio.shield(self.pool_task)
 
     async def session(self):
         return self.requests_session
 
+    def cache(self, name):
+        return self.caches[name]
+
+    async def run_blocking(self, func, *args, **kwargs):
+        '''Calls a synchronous function in one of the executor's threads and waits for it without blocking the event loop.'''
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def osu_user(self, user, type='id'):
+        '''Returns the cached get_user json for a user id or username, fetching it from the osu! api on a miss.'''
+        cache = self.cache('osu_users')
+        key = f'{type}:{str(user).lower()}'
+
+        async def fetch():
+            json = (await self.osu.v1('get_user', u=user, type=type, m=0))[0]
+            # Only keep what we use so the persisted cache stays small
+            json = {field: json[field] for field in ['user_id', 'username', 'country', 'pp_rank']}
+            # Save a lookup the next time this user is referred to the other way
+            other_key = f'string:{json["username"].lower()}' if type == 'id' else f'id:{json["user_id"]}'
+            cache.set(other_key, json)
+            return json
+        return await cache.get_or_fetch(key, fetch)
+
+    async def osu_users(self, user_ids, refresh=False):
+        '''Returns a dictionary of user id to get_user style json for every user id given that exists.
+        Users that aren't cached are looked up through api v2, 50 at a time. `refresh` ignores what's cached.'''
+        cache = self.cache('osu_users')
+        found = {} if refresh else {str(user_id): cache.get(f'id:{user_id}') for user_id in user_ids}
+        missing = {str(user_id) for user_id in user_ids if found.get(str(user_id)) is None}
+        for json in await self.osu.users(missing):
+            # Convert to the same shape as api v1's get_user so it shares the cache with osu_user()
+            rank = (json.get('statistics_rulesets') or {}).get('osu', {}).get('global_rank')
+            json = {'user_id': str(json['id']), 'username': json['username'], 'country': json['country_code'], 'pp_rank': str(rank or 0)}
+            cache.set(f'id:{json["user_id"]}', json)
+            cache.set(f'string:{json["username"].lower()}', json)
+            found[json['user_id']] = json
+        # Restricted and deleted users are left out by the api
+        return {user_id: found[str(user_id)] for user_id in user_ids if found.get(str(user_id)) is not None}
+
+    async def osu_beatmaps(self, beatmap_ids):
+        '''Returns a dictionary of beatmap id to get_beatmaps style json for every beatmap id given that exists.
+        Beatmaps that aren't in the beatmaps table are looked up through api v2, 50 at a time, and saved to it.'''
+        missing = {str(beatmap_id) for beatmap_id in beatmap_ids if str(beatmap_id) not in self.beatmaps}
+        fetched = []
+        for json in await self.osu.beatmaps(missing):
+            # Convert to the same fields as api v1's get_beatmaps, plus what the pooling tools show
+            fetched.append({'beatmap_id': str(json['id']), 'artist': json['beatmapset']['artist'], 'title': json['beatmapset']['title'],
+                            'version': json['version'], 'stars': json['difficulty_rating'], 'bpm': json['bpm'],
+                            'ar': json['ar'], 'od': json['accuracy'], 'length': json['total_length']})
+        if fetched:
+            self.beatmaps.update((json['beatmap_id'], json) for json in fetched)
+            # Saved in the background so reports never wait on, or fail because of, the database
+            task = asyncio.create_task(self._save_beatmaps(fetched))
+            self.background_tasks.add(task)
+            task.add_done_callback(self.background_tasks.discard)
+        return {beatmap_id: self.beatmaps[str(beatmap_id)] for beatmap_id in beatmap_ids if str(beatmap_id) in self.beatmaps}
+
+    async def _save_beatmaps(self, beatmaps):
+        '''Stores beatmaps in the beatmaps table so they don't have to be fetched again after a restart.'''
+        try:
+            async with (await self.connpool()).acquire() as conn:
+                await conn.executemany('''insert into beatmaps (beatmap_id, artist, title, version, stars, bpm, ar, od, length)
+                                          values ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+                                          on conflict (beatmap_id) do update set artist=excluded.artist, title=excluded.title,
+                                          version=excluded.version, stars=excluded.stars, bpm=excluded.bpm, ar=excluded.ar,
+                                          od=excluded.od, length=excluded.length, fetched_at=now();''',
+                                       [(int(json['beatmap_id']), json['artist'], json['title'], json['version'], json['stars'],
+                                         json['bpm'], json['ar'], json['od'], json['length']) for json in beatmaps])
+        except Exception:
+            # They're still kept in memory, and fetched and saved again after a restart
+            errorcog = self.bot.get_cog('ErrorReportingCog')
+            await errorcog.on_error('anzt.resources.save_beatmaps')
+
+    def stats(self):
+        '''Returns a dictionary of section name to lines describing the state of the shared resources. See !stats'''
+        return {
+            'Caches': [f'{name}: {cache.stats()}' for name, cache in self.caches.items()] + [f'beatmaps: {len(self.beatmaps)} stored'],
+            'osu! api': self.osu.stats(),
+            'HTTP': self.http_stats.stats(),
+            'Google Sheets': self.sheets.stats() + self.sheet_writes.stats(),
+            'Postgres': self.pool_task.result().stats() if self.pool_task.done() and not self._pool_failed() else ['Not connected'],
+        }
+
     def _get_creds(self):
-        # Looks up one directory from this file. OS and launch location independant.
+        # gspread_asyncio calls this from a thread when it (re)authenticates. Looks up one directory from this file. OS and launch location independant.
         client_secret = path.join(path.split(path.dirname(__file__))[0], 'client_secret.json')
         creds = Credentials.from_service_account_file(client_secret)
         scoped = creds.with_scopes([
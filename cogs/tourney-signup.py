@@ -1,6 +1,8 @@
 import asyncio
 import pickle
+from csv import writer as csv_writer
 from datetime import datetime
+from io import BytesIO, StringIO
 
 from asyncpg.exceptions import UniqueViolationError
 from cryptography.fernet import Fernet, InvalidToken
@@ -10,7 +12,7 @@ from discord.ext import commands
 from discord.ext.commands.converter import MessageConverter
 from discord.ext.commands.errors import CommandInvokeError, MessageNotFound
 from gspread.exceptions import APIError
-from utility_funcs import get_exposed_settings, get_setting, request, res_cog
+from utility_funcs import get_exposed_settings, get_setting, res_cog
 
 
 class TourneySignupCog(commands.Cog):
@@ -19,6 +21,7 @@ class TourneySignupCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.prompted_users = []
+        self.server = None
 
     async def _connpool(self):
         return await res_cog(self.bot).connpool()
@@ -244,27 +247,24 @@ class TourneySignupCog(commands.Cog):
 
         # Persist in spreadsheet
         setts = get_exposed_settings("tourney-signup")
-        agc = await res_cog(self.bot).agc()
         try:
-            sh = await agc.open_by_url(setts["sheet_url"])
+            ws = await res_cog(self.bot).sheets.worksheet(setts["sheet_url"], setts["sheet_tab_name"])
         except APIError as e:
             if e.args[0]['status'] == 'PERMISSION_DENIED':
                 print('no perms. share with anzt-bot@anzt-bot.iam.gserviceaccount.com')
             return
-        ws = await sh.worksheet(setts["sheet_tab_name"])
 
         disc_user = self.bot.get_user(int(discord_id))
 
         await self.give_participant_role(discord_id)
 
-        apiKey = get_setting('osu', 'apikey')
-        json = await request(f'https://osu.ppy.sh/api/get_user?k={apiKey}&u={osu_id}&type=id&m=0', self.bot)
-        json = json[0]
+        json = await res_cog(self.bot).osu_user(osu_id)
         osu_username = json['username']
         rank = json['pp_rank']
         country = json['country']
 
-        await ws.append_row([osu_id, osu_username, country, rank, str(disc_user), discord_id])
+        # Queued so a rush of signups is written in one request rather than going over the sheets quota
+        res_cog(self.bot).sheet_writes.append(ws, [osu_id, osu_username, country, rank, str(disc_user), discord_id])
 
     async def give_participant_role(self, discord_id):
         anztguild = self.bot.get_guild(199158455888642048)
@@ -277,24 +277,51 @@ class TourneySignupCog(commands.Cog):
     async def csv(self, ctx):
         await ctx.message.delete()
 
-        filename = 'signups.csv'
+        # Copied into memory instead of a file on disk, which would block the event loop while it's written and read.
+        # A coroutine is given since asyncpg writes to file objects from a thread.
+        output = BytesIO()
+
+        async def write(data):
+            output.write(data)
+
         async with (await self._connpool()).acquire() as conn:
             async with conn.transaction():
-                await conn.copy_from_query('select * from signups', output=filename, format='csv', header=True)
-        with open(filename, 'rb') as fp:
-            await ctx.send(file=File(fp, filename))
+                await conn.copy_from_query('select * from signups', output=write, format='csv', header=True)
+        output.seek(0)
+        await ctx.send(file=File(output, 'signups.csv'))
+
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def ranks(self, ctx):
+        '''Sends a csv of every signup's current username, country and rank, looked up 50 players at a time.'''
+        await ctx.message.delete()
+
+        async with (await self._connpool()).acquire() as conn:
+            signups = await conn.fetch('select discord_id, osu_id from signups order by osu_id')
+        users = await res_cog(self.bot).osu_users([str(signup['osu_id']) for signup in signups], refresh=True)
+
+        output = StringIO()
+        writer = csv_writer(output)
+        writer.writerow(['osu_id', 'username', 'country', 'rank', 'discord_id'])
+        for signup in signups:
+            json = users.get(str(signup['osu_id']), {'username': '', 'country': '', 'pp_rank': ''})
+            writer.writerow([signup['osu_id'], json['username'], json['country'], json['pp_rank'], signup['discord_id']])
+        missing = len(signups) - len(users)
+        await ctx.send(f'{len(signups)} signups, {missing} not found on osu!',
+                       file=File(BytesIO(output.getvalue().encode()), 'ranks.csv'))
 
     @commands.Cog.listener()
     async def on_ready(self):
-        # Wait for error cog to be ready
-        await asyncio.sleep(5)
+        # on_ready fires again after reconnecting to discord but the server is still running
+        if self.server is not None:
+            return
         await self.load_from_settings()
+        self.server = await asyncio.start_server(self.handler, '127.0.0.1', 7865)
 
-        server = await asyncio.start_server(self.handler, '127.0.0.1', 7865)
-        addr = server.sockets[0].getsockname()
+        addr = self.server.sockets[0].getsockname()
         print(f'Serving on {addr}')
-        async with server:
-            await server.serve_forever()
+        async with self.server:
+            await self.server.serve_forever()
 
 
 async def setup(bot):
@@ -5,7 +5,8 @@ from requests.api import get
 import twitch
 from discord import Embed, Streaming
 from discord.ext import commands, tasks
-from utility_funcs import is_channel, get_setting
+from metrics import registry
+from utility_funcs import is_channel, get_setting, res_cog
 
 
 class TwitchAndPickemsCog(commands.Cog):
@@ -39,8 +40,8 @@ class TwitchAndPickemsCog(commands.Cog):
                 await self.bot.wait_until_ready()
                 # Give the error reporting cog some time to do what's in it's on_ready listener before it's ready to handle errors
                 await asyncio.sleep(1)
-            self.client.get_oauth()
-            data = self.client.get_streams(user_logins=[twitchannel])
+            with registry.time('anzt_outbound_seconds', dependency='twitch', operation='get_streams'):
+                data = await res_cog(self.bot).run_blocking(self.get_streams, twitchannel)
             live = str(data) != '[]'
             if live:
                 data = data[0]
@@ -70,6 +71,11 @@ class TwitchAndPickemsCog(commands.Cog):
             errorcog = self.bot.get_cog('ErrorReportingCog')
             await errorcog.on_error('anzt.twitch.loop')
 
+    def get_streams(self, twitchannel):
+        # The twitch client makes requests synchronously so this is run in a thread
+        self.client.get_oauth()
+        return self.client.get_streams(user_logins=[twitchannel])
+
     async def do_stream_ping(self, data):
         url = f'https://www.twitch.tv/{data["user_name"]}'
         embed = Embed(title=f'**{data["title"]}**', url=url, color=0x9146ff)
@@ -0,0 +1,58 @@
+import time
+
+from metrics import LatencyStats, registry
+
+
+class InstrumentedPool:
+    '''Wraps an asyncpg pool to count connections in use and callers waiting for one, and to time how long acquiring takes.
+    Anything other than acquire() is passed straight through to the pool.'''
+
+    def __init__(self, pool, max_size):
+        self.pool = pool
+        self.max_size = max_size
+        self.in_use = 0
+        self.waiting = 0
+        self.peak_in_use = 0
+        self.acquire_latency = LatencyStats()
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+    def acquire(self, timeout=None):
+        return _Acquire(self, timeout)
+
+    def stats(self):
+        return [f'{self.in_use}/{self.max_size} connections in use (peak {self.peak_in_use}), {self.waiting} waiting',
+                f'acquire: {self.acquire_latency.summary()}']
+
+
+class _Acquire:
+    def __init__(self, pool, timeout):
+        self.pool = pool
+        self.timeout = timeout
+        self.conn = None
+
+    async def __aenter__(self):
+        pool = self.pool
+        pool.waiting += 1
+        start = time.perf_counter()
+        try:
+            self.conn = await pool.pool.acquire(timeout=self.timeout)
+        except BaseException:
+            pool.acquire_latency.observe(time.perf_counter() - start, error=True)
+            raise
+        finally:
+            pool.waiting -= 1
+        pool.acquire_latency.observe(time.perf_counter() - start)
+        registry.histogram('anzt_outbound_seconds', dependency='postgres', operation='acquire').observe(time.perf_counter() - start)
+        pool.in_use += 1
+        pool.peak_in_use = max(pool.peak_in_use, pool.in_use)
+        self.acquired_at = time.perf_counter()
+        return self.conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.pool.in_use -= 1
+        # How long the connection was held for covers every query made with it
+        registry.histogram('anzt_outbound_seconds', dependency='postgres', operation='connection').observe(
+            time.perf_counter() - self.acquired_at, error=exc_type is not None)
+        await self.pool.pool.release(self.conn)
@@ -0,0 +1,74 @@
+import hashlib
+import json
+
+import discord
+
+# Players that fit in a qualifier lobby
+lobby_size = 16
+
+# Every qualifier lobby with its referee's name and its players' names, on the same row as the persistent message showing
+# the lobby's day. Days without lobbies come back as one row with null lobby columns. A message can show several days.
+lobbies_query = '''select m.message_id, m.day, m.thumbnail_url, l.lobby_id, l.time, s.staff_osu_username as referee,
+                          array_remove(array_agg(p.osu_username order by p.osu_username), null) as players
+                   from persistent_messages m
+                   left join lobbies l on l.time >= m.day and l.time < m.day + 1
+                   left join staff s on s.staff_osu_id = l.staff_osu_id
+                   left join lobby_signups ls on ls.lobby_id = l.lobby_id
+                   left join players p on p.osu_id = ls.osu_id
+                   where m.day is not null
+                   group by m.message_id, m.day, m.thumbnail_url, l.lobby_id, s.staff_osu_id
+                   order by m.day, l.time, l.lobby_id;'''
+
+
+def group_by_message(rows):
+    '''Returns [(message_id, [(thumbnail_url, [lobby rows]) for each day it shows])] in day order from the rows of lobbies_query.'''
+    messages = []
+    day = None
+    for row in rows:
+        if not messages or messages[-1][0] != row['message_id']:
+            messages.append((row['message_id'], []))
+            day = None
+        if row['day'] != day:
+            day = row['day']
+            messages[-1][1].append((row['thumbnail_url'], []))
+        if row['lobby_id'] is not None:
+            messages[-1][1][-1][1].append(row)
+    return messages
+
+
+def lobby_field(lobby):
+    '''Returns the (name, value) of a lobby's embed field. lobby needs time, lobby_id, referee and players.'''
+    time = lobby['time']
+    players = lobby['players']
+    # datetime didn't have an easy way to get lowercase am/pm so I just did it manually
+    timestring = f'{time.hour%12}:{str(time.minute).zfill(2)}{"am" if time.hour < 12 else "pm"}'
+    # uses discord emotes to represent time with an analog clock emote
+    name = f':clock{time.hour%12 if time.hour%12 != 0 else 12}: {timestring}'
+
+    free_spots = lobby_size - len(players)
+    if free_spots == 0:
+        emote = ':red_circle:'
+    elif free_spots == lobby_size:
+        emote = ':orange_circle:'
+    else:
+        emote = ':green_circle:'
+    playerstring = '    '.join(players) if len(players) > 0 else '-'
+    reff = f' | Reffed by {lobby["referee"]}' if lobby['referee'] else ''
+    value = f'{emote} **ID: {lobby["lobby_id"]}** | {free_spots} free spots{reff}```{playerstring}```'
+    return name, value
+
+
+def render_lobby_embed(thumbnail_url, lobbies):
+    '''Builds the embed listing a day's lobbies, which should already be in time order.
+    Doesn't do any I/O so it can be benchmarked offline.'''
+    embed = discord.Embed(color=discord.Colour(0x6e95fc))
+    embed.set_thumbnail(url=thumbnail_url)
+    for lobby in lobbies:
+        name, value = lobby_field(lobby)
+        embed.add_field(name=name, inline=False, value=value)
+    return embed
+
+
+def embeds_hash(embeds):
+    '''Returns a digest of what a message's embeds show, to tell whether editing the message would change anything.'''
+    return hashlib.sha1(json.dumps([embed.to_dict() for embed in embeds], sort_keys=True).encode()).hexdigest()
@@ -8,6 +8,7 @@ from utility_funcs import get_setting
 initial_extensions = ['cogs.' + name for name in [
     'owner',
     'error-reporting',
+    'metrics',
     'resources',
     'tourney-signup',
     'twitch-pickem',
@@ -0,0 +1,123 @@
+import discord
+
+
+class ReportError(Exception):
+    '''Raised when a match can't be reported. The message is shown to whoever asked for the report.'''
+
+
+def filter_games(lobbyjson, pool, referees):
+    '''Returns (game, scores) pairs for every game in a get_match json that used a beatmap from the pool and wasn't aborted.
+    Scores made by referees are left out and the rest are sorted highest first.'''
+    games = []
+    for game in lobbyjson['games']:
+        if game['end_time'] is None or int(game['beatmap_id']) not in pool:
+            continue
+        scores = [score for score in game['scores'] if int(score['user_id']) not in referees]
+        scores.sort(key=lambda score: int(score['score']), reverse=True)
+        games.append((game, scores))
+    return games
+
+
+def required_lookups(sheet, lobbyjson, pool, referees, seen_games=()):
+    '''Returns the player usernames, winner user ids and beatmap ids that render_match_embed() needs looked up.
+    Games with an id in seen_games are skipped.'''
+    data = sheet['data']
+    usernames = [username for username in [data['p1_username'], data['p2_username']] if username != []]
+    games = [(game, scores) for game, scores in filter_games(lobbyjson, pool, referees) if game['game_id'] not in seen_games]
+    user_ids = list({scores[0]['user_id'] for _, scores in games if scores})
+    beatmap_ids = list({int(game['beatmap_id']) for game, _ in games})
+    return usernames, user_ids, beatmap_ids
+
+
+def render_match_embed(match_id, sheet, lobbyjson, pool, players, users, beatmaps, referees, tourney_round,
+                       schedule_entry={}, reporter='', live=False):
+    '''Builds a match's result embed. Doesn't do any I/O so it can be profiled and tested offline.
+
+    sheet is a match's sheet data as returned by MatchResultPostingCog.read_sheet(), lobbyjson is the lobby's get_match json
+    and pool is a dictionary of beatmap id to pick (e.g. NM1). players maps the sheet's usernames to their get_user json,
+    users maps winners' user ids to their get_user json and beatmaps maps beatmap ids to their get_beatmaps json.
+    When live is True, the match score is counted from the lobby rather than read from the sheet.
+    Raises ReportError if the sheet is missing something.'''
+    data = sheet['data']
+    p1 = {'username': data['p1_username'], 'score': data['p1_score'], 'ban1': data['p1_ban_1'][0:3], 'ban2': data['p1_ban_2'][0:3], 'protect1': data['p1_protect'][0:3]}
+    p2 = {'username': data['p2_username'], 'score': data['p2_score'], 'ban1': data['p2_ban_1'][0:3], 'ban2': data['p2_ban_2'][0:3], 'protect1': data['p2_protect'][0:3]}
+    if live:
+        p1['score'] = p2['score'] = '0'
+    if [] in p1.values() or [] in p2.values():
+        raise ReportError('Sheet is missing one or all of player\'s usernames, scores, bans or rolls.')
+
+    firstpick = data['first_pick']
+    if firstpick not in [p1['username'], p2['username']]:
+        raise ReportError(f'Failed to find who picked first by looking at the sheet for match: {match_id}')
+
+    # Get TB bans, but only if they are present
+    p1_tb_ban = data['p1_ban_tb'][0:3]
+    p2_tb_ban = data['p2_ban_tb'][0:3]
+    # Check if either cell is empty. Represented by either "TB0" or [].
+    if any(x in [p1_tb_ban, p2_tb_ban] for x in ['TB0', []]):
+        p1_tb_ban = p2_tb_ban = ''
+    else:
+        p1_tb_ban = ', ' + p1_tb_ban
+        p2_tb_ban = ', ' + p2_tb_ban
+
+    games = filter_games(lobbyjson, pool, referees)
+    p1['flag'] = players[p1['username']]['country'].lower()
+    p2['flag'] = players[p2['username']]['country'].lower()
+
+    if live:
+        # The sheet's score isn't kept up to date while a match is being played
+        for player in [p1, p2]:
+            player['score'] = str(sum(1 for _, scores in games if users[scores[0]['user_id']]['username'].lower() == player['username'].lower()))
+
+    # Used to line up the scores horizontally by left justifying the username to this amount
+    longest_name_len = len(max([p1['username'], p2['username']], key=len))
+    # Highlight who the winner was using bold and an emoji
+    if p1['score'] > p2['score']:
+        p1['score'] = f'**{p1["score"]}** :trophy:'
+    elif p1['score'] < p2['score']:
+        p2['score'] = f'**{p2["score"]}** :trophy:'
+
+    # Construct the embed
+    description = (f':flag_{p1["flag"]}: `{p1["username"].ljust(longest_name_len)} -` {p1["score"]}\n'
+                   f'Bans: {p1["ban1"]}, {p1["ban2"]} - Protects: {p1["protect1"]}\n'
+                   f':flag_{p2["flag"]}: `{p2["username"].ljust(longest_name_len)} -` {p2["score"]}\n'
+                   f'Bans: {p2["ban1"]}, {p2["ban2"]} - Protects: {p2["protect1"]}')
+    embed = discord.Embed(title=f'Match ID: {match_id}', description=description, color=0xe47607)
+    embed.set_author(name=f'{tourney_round}: ({p1["username"]}) vs ({p2["username"]})',
+                     url=f'https://osu.ppy.sh/mp/{sheet["lobby_id"]}')
+
+    # Add streamer and referee to footer
+    referee = schedule_entry.get('referee', '')
+    streamer = schedule_entry.get('streamer', '')
+    footer = f'Refereed by {referee}' if referee else f'Reported by {reporter}'
+    footer += f' - Streamed by {streamer}' if streamer else ''
+    embed.set_footer(text=footer)
+
+    # Construct the fields within the embed, displaying each pick and score differences
+    orange = ':small_orange_diamond:'
+    blue = ':small_blue_diamond:'
+    tiebreaker = ':diamond_shape_with_a_dot_inside:'
+    for i, (game, scores) in enumerate(games):
+        emote = orange if i % 2 == 0 else blue
+        # Alternate players starting from whoever the sheet says had first pick
+        picker = p1['username'] if (i % 2 == 0 if firstpick == p1['username'] else i % 2 != 0) else p2['username']
+        bmapID = int(game['beatmap_id'])
+        bmapJson = beatmaps[bmapID]
+        bmapFormatted = f"{bmapJson['artist']} - {bmapJson['title']} [{bmapJson['version']}]"
+        winner = users[scores[0]['user_id']]['username']
+
+        # Check if map was tiebreaker
+        if pool[bmapID].startswith('TB'):
+            firstline = f'{tiebreaker} **Tiebreaker** [{pool[bmapID]}]'
+        else:
+            firstline = f'{emote}Pick #{i+1} by __{picker}__ [{pool[bmapID]}]'
+        # One or both players didn't play a map
+        if len(scores) < 2:
+            embed.add_field(name=firstline,
+                            value=f'[{bmapFormatted}](https://osu.ppy.sh/b/{bmapID})\n'
+                            f'__{winner} ({int(scores[0]["score"]):,})__ wins. Other score missing.', inline=False)
+        else:
+            embed.add_field(name=firstline,
+                            value=f'[{bmapFormatted}](https://osu.ppy.sh/b/{bmapID})\n'
+                            f'__{winner} ({int(scores[0]["score"]):,})__ wins by **({int(scores[0]["score"])-int(scores[1]["score"]):,})**', inline=False)
+    return embed
@@ -0,0 +1,239 @@
+import time
+from bisect import bisect_left
+from collections import defaultdict, deque
+
+import aiohttp
+
+
+class LatencyStats:
+    '''Counts calls and errors and keeps the most recent latencies of something to report percentiles from.'''
+
+    def __init__(self, samples=512):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=samples)
+
+    def observe(self, seconds, error=False):
+        self.count += 1
+        self.errors += error
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+
+    def time(self):
+        '''Context manager that observes how long its body took, counting it as an error if it raised.'''
+        return _Timer(self)
+
+    def percentile(self, fraction):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+    def summary(self):
+        mean = self.total / self.count if self.count else 0
+        return (f'{self.count} calls, {self.errors} errors, avg {mean*1000:.0f}ms, '
+                f'p95 {self.percentile(0.95)*1000:.0f}ms, max {self.max*1000:.0f}ms')
+
+
+class _Timer:
+    def __init__(self, stats):
+        self.stats = stats
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stats.observe(time.perf_counter() - self.start, error=exc_type is not None)
+
+
+# Upper bounds in seconds of the buckets histograms count observations in
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    '''Counts observations into fixed buckets like a Prometheus histogram, plus how many of them were errors.'''
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        # The last count is for observations bigger than every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.errors = 0
+        self.sum = 0.0
+
+    def observe(self, seconds, error=False):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.errors += error
+        self.sum += seconds
+
+    def time(self):
+        '''Context manager that observes how long its body took, counting it as an error if it raised.'''
+        return _Timer(self)
+
+    def quantile(self, fraction):
+        '''Estimates a quantile by interpolating within the bucket it falls in.'''
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i-1] if i > 0 else 0.0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def summary(self):
+        mean = self.sum / self.count if self.count else 0
+        return (f'{self.count} calls, {self.errors} errors, avg {mean*1000:.0f}ms, '
+                f'p50 ~{self.quantile(0.5)*1000:.0f}ms, p95 ~{self.quantile(0.95)*1000:.0f}ms')
+
+
+class Registry:
+    '''Process wide collection of labelled histograms, shown by !stats and served to Prometheus by MetricsCog.'''
+
+    def __init__(self, help):
+        # Metric name to its help text, and (name, labels) to the histogram for that combination of labels
+        self.help = help
+        self.histograms = {}
+
+    def histogram(self, metric, **labels):
+        '''Returns the histogram for a metric and labels, creating it the first time.'''
+        key = (metric, tuple(sorted((label, str(value)) for label, value in labels.items())))
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        return self.histograms[key]
+
+    def time(self, metric, **labels):
+        return self.histogram(metric, **labels).time()
+
+    def stats(self):
+        '''Returns a dictionary of metric name to a summary line for each of its label combinations, for !stats.'''
+        sections = defaultdict(list)
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            label_text = ' '.join(value for _, value in labels) or 'all'
+            sections[name].append(f'{label_text}: {histogram.summary()}')
+        return dict(sections)
+
+    def prometheus(self):
+        '''Renders every histogram in Prometheus' text exposition format.'''
+        lines = []
+        by_name = defaultdict(list)
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            by_name[name].append((labels, histogram))
+        for name, histograms in by_name.items():
+            lines.append(f'# HELP {name} {self.help.get(name, name)}')
+            lines.append(f'# TYPE {name} histogram')
+            for labels, histogram in histograms:
+                cumulative = 0
+                for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    bucket_labels = _labels(labels + (('le', str(bound)),))
+                    lines.append(f'{name}_bucket{bucket_labels} {cumulative}')
+                lines.append(f'{name}_sum{_labels(labels)} {histogram.sum}')
+                lines.append(f'{name}_count{_labels(labels)} {histogram.count}')
+            lines.append(f'# TYPE {name}_errors_total counter')
+            for labels, histogram in histograms:
+                lines.append(f'{name}_errors_total{_labels(labels)} {histogram.errors}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{label}="{value}"' for (label, _), value in zip(labels, escaped)) + '}'
+
+
+registry = Registry({
+    'anzt_command_seconds': 'Time taken to run prefix commands, by command',
+    'anzt_interaction_seconds': 'Time taken to handle app commands and component interactions, by name',
+    'anzt_outbound_seconds': 'Time taken by calls to other services, by dependency (osu, twitch, sheets, postgres, discord) and operation',
+    'anzt_loop_lag_seconds': 'How late the event loop was to wake up from a sleep',
+    'anzt_loop_stall_seconds': 'How long the event loop was blocked for each time it went over MetricsCog.stall_threshold',
+})
+
+
+class HttpStats:
+    '''Collects per host latency, how often connections are reused and how long requests wait for a free connection
+    from the trace hooks of an aiohttp session. Pass trace_config() to the session's trace_configs.'''
+
+    # Hosts whose requests are counted under a dependency in anzt_outbound_seconds, labelled with the request's path
+    dependencies = {'osu.ppy.sh': 'osu', 'id.twitch.tv': 'twitch', 'api.twitch.tv': 'twitch'}
+
+    def __init__(self):
+        self.latency = defaultdict(LatencyStats)
+        self.queued = LatencyStats()
+        self.connect = LatencyStats()
+        self.reused = 0
+        self.created = 0
+        self.dns_hits = 0
+        self.dns_misses = 0
+
+    def trace_config(self):
+        config = aiohttp.TraceConfig()
+        config.on_request_start.append(self._request_start)
+        config.on_request_end.append(self._request_end)
+        config.on_request_exception.append(self._request_exception)
+        config.on_connection_queued_start.append(self._queued_start)
+        config.on_connection_queued_end.append(self._queued_end)
+        config.on_connection_create_start.append(self._create_start)
+        config.on_connection_create_end.append(self._create_end)
+        config.on_connection_reuseconn.append(self._reuseconn)
+        config.on_dns_cache_hit.append(self._dns_hit)
+        config.on_dns_cache_miss.append(self._dns_miss)
+        return config
+
+    async def _request_start(self, session, ctx, params):
+        ctx.start = time.perf_counter()
+
+    async def _request_end(self, session, ctx, params):
+        self._observe(params.url, time.perf_counter() - ctx.start)
+
+    async def _request_exception(self, session, ctx, params):
+        self._observe(params.url, time.perf_counter() - ctx.start, error=True)
+
+    def _observe(self, url, seconds, error=False):
+        self.latency[url.host].observe(seconds, error)
+        if url.host in self.dependencies:
+            registry.histogram('anzt_outbound_seconds', dependency=self.dependencies[url.host], operation=url.path).observe(seconds, error)
+        else:
+            registry.histogram('anzt_outbound_seconds', dependency=url.host, operation='').observe(seconds, error)
+
+    async def _queued_start(self, session, ctx, params):
+        ctx.queued_at = time.perf_counter()
+
+    async def _queued_end(self, session, ctx, params):
+        self.queued.observe(time.perf_counter() - ctx.queued_at)
+
+    async def _create_start(self, session, ctx, params):
+        ctx.connecting_at = time.perf_counter()
+
+    async def _create_end(self, session, ctx, params):
+        self.created += 1
+        self.connect.observe(time.perf_counter() - ctx.connecting_at)
+
+    async def _reuseconn(self, session, ctx, params):
+        self.reused += 1
+
+    async def _dns_hit(self, session, ctx, params):
+        self.dns_hits += 1
+
+    async def _dns_miss(self, session, ctx, params):
+        self.dns_misses += 1
+
+    def stats(self):
+        lines = [f'{host}: {stats.summary()}' for host, stats in sorted(self.latency.items())]
+        connections = self.reused + self.created
+        reuse_rate = self.reused / connections if connections else 0
+        lines.append(f'{self.reused}/{connections} requests reused a connection ({reuse_rate:.0%}), {self.dns_hits} dns cache hits, {self.dns_misses} misses')
+        lines.append(f'connecting: {self.connect.summary()}')
+        lines.append(f'queued for a connection: {self.queued.summary()}')
+        return lines
@@ -0,0 +1,153 @@
+import asyncio
+import random
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from metrics import LatencyStats
+from utility_funcs import get_setting
+
+
+class OsuApiError(Exception):
+    '''Raised when the osu! api returns a status code other than 200, or keeps failing after being retried.'''
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class TokenBucket:
+    '''Allows bursts of up to `capacity` requests and `rate` requests per second after that.'''
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class OsuApiClient:
+    '''Client for the osu! api shared by every cog through ResourcesCog.osu.
+
+    Requests are rate limited with a token bucket and retried with jittered exponential backoff on 429s, 5xxs and
+    connection errors. Identical requests made while one is already in flight wait for and share its result.'''
+    # osu! allows 1200 requests a minute on api v1. Stay well under that.
+    rate = 8
+    burst = 20
+    retries = 3
+    backoff = 0.5
+    # Most ids api v2 accepts in one request to its bulk endpoints
+    batch_size = 50
+
+    def __init__(self, session):
+        self.session = session
+        self.bucket = TokenBucket(self.rate, self.burst)
+        self.in_flight = {}
+        self.latency = defaultdict(LatencyStats)
+        self.retried = 0
+        self.coalesced = 0
+        self.token = None
+        self.token_expires = 0
+        self.token_lock = asyncio.Lock()
+
+    async def v1(self, endpoint, **params):
+        '''Returns the json from an api v1 endpoint, e.g. v1('get_user', u=4294475, type='id').'''
+        params['k'] = get_setting('osu', 'apikey')
+        return await self.get(f'https://osu.ppy.sh/api/{endpoint}', params=params)
+
+    async def v2(self, path, params={}):
+        '''Returns the json from an api v2 endpoint, authenticating as the bot with the client credentials grant.
+        Params can be a list of pairs to repeat a parameter, e.g. v2('users', [('ids[]', 2), ('ids[]', 3)]).'''
+        headers = {'Authorization': f'Bearer {await self.v2_token()}'}
+        return await self.get(f'https://osu.ppy.sh/api/v2/{path}', headers=headers, params=params)
+
+    async def v2_token(self):
+        '''Returns a cached client credentials token, getting a new one when it's close to expiring.'''
+        async with self.token_lock:
+            if self.token is None or self.token_expires < time.time() + 60:
+                # The same osu! application is used for the signup OAuth flow
+                setts = get_setting('tourney-signup')
+                data = {
+                    'client_id': setts['osu_app_client_id'],
+                    'client_secret': setts['osu_app_client_secret'],
+                    'grant_type': 'client_credentials',
+                    'scope': 'public'
+                }
+                async with self.session.post('https://osu.ppy.sh/oauth/token', data=data) as r:
+                    if r.status != 200:
+                        raise OsuApiError(f'Failed to get an api v2 token. Status code {r.status}', r.status)
+                    json = await r.json()
+                self.token = json['access_token']
+                self.token_expires = time.time() + json['expires_in']
+        return self.token
+
+    async def users(self, user_ids):
+        '''Returns the api v2 json of every user id given, in as few requests as possible.'''
+        return await self._bulk('users', 'users', user_ids)
+
+    async def beatmaps(self, beatmap_ids):
+        '''Returns the api v2 json of every beatmap id given, in as few requests as possible.'''
+        return await self._bulk('beatmaps', 'beatmaps', beatmap_ids)
+
+    async def _bulk(self, path, key, ids):
+        ids = list(ids)
+        batches = [ids[i:i+self.batch_size] for i in range(0, len(ids), self.batch_size)]
+        results = await asyncio.gather(*[self.v2(path, [('ids[]', id) for id in batch]) for batch in batches])
+        return [item for result in results for item in result[key]]
+
+    async def get(self, url, headers={}, params={}):
+        if isinstance(params, dict):
+            params = list(params.items())
+        key = (url, tuple(sorted(headers.items())), tuple((k, str(v)) for k, v in params))
+        if key in self.in_flight:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(self._get(url, headers, params))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        # Shielded so one caller being cancelled doesn't cancel the request for everyone else waiting on it
+        return await asyncio.shield(self.in_flight[key])
+
+    async def _get(self, url, headers, params):
+        endpoint = urlsplit(url).path
+        for attempt in range(self.retries + 1):
+            await self.bucket.acquire()
+            retry_after = None
+            start = time.perf_counter()
+            try:
+                async with self.session.get(url, headers=headers, params=params) as r:
+                    if r.status == 200:
+                        json = await r.json()
+                        self.latency[endpoint].observe(time.perf_counter() - start)
+                        return json
+                    self.latency[endpoint].observe(time.perf_counter() - start, error=True)
+                    if r.status != 429 and r.status < 500:
+                        raise OsuApiError(f'osu! api returned status code {r.status} for {endpoint}', r.status)
+                    error = OsuApiError(f'osu! api returned status code {r.status} for {endpoint}', r.status)
+                    if 'Retry-After' in r.headers:
+                        retry_after = float(r.headers['Retry-After'])
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.latency[endpoint].observe(time.perf_counter() - start, error=True)
+                error = OsuApiError(f'Couldn\'t reach the osu! api for {endpoint}: {type(e).__name__}')
+
+            if attempt < self.retries:
+                self.retried += 1
+                await asyncio.sleep(retry_after or self.backoff * 2**attempt * random.uniform(0.5, 1.5))
+        raise error
+
+    def stats(self):
+        lines = [f'{endpoint}: {stats.summary()}' for endpoint, stats in sorted(self.latency.items())]
+        lines.append(f'{self.retried} retries, {self.coalesced} coalesced requests, {len(self.in_flight)} in flight')
+        return lines
@@ -0,0 +1,117 @@
+import asyncio
+import cProfile
+import pstats
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from io import StringIO
+from os import path
+
+
+def async_stack(coro):
+    '''Returns the chain of coroutines a coroutine is awaiting, outermost first, ending in whatever it's waiting on.'''
+    stack = []
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None) or getattr(coro, 'ag_frame', None)
+        if frame is None:
+            # A future or something else that isn't a coroutine
+            stack.append(type(coro).__name__)
+            break
+        stack.append(f'{frame.f_code.co_name} ({path.basename(frame.f_code.co_filename)})')
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None) or getattr(coro, 'ag_await', None)
+    return stack
+
+
+class AsyncSampler(threading.Thread):
+    '''Samples what a task is awaiting every `interval` seconds from another thread, so time spent waiting on I/O shows up
+    as well as time spent running. The samples are kept as collapsed stacks, the input format of flamegraph.pl.'''
+
+    def __init__(self, task, interval=0.005):
+        super().__init__(daemon=True)
+        self.task = task
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                stack = async_stack(self.task.get_coro())
+            except (AttributeError, RuntimeError, ValueError):
+                # The frames changed while being walked. Skip this sample.
+                continue
+            if stack:
+                self.stacks[';'.join(stack)] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+async def profile(coro, sample_interval=0.005):
+    '''Runs a coroutine as its own task under cProfile and an AsyncSampler.
+    Returns (wall clock seconds, cProfile stats as text, collapsed async stacks).'''
+    profiler = cProfile.Profile()
+    task = asyncio.ensure_future(coro)
+    sampler = AsyncSampler(task, sample_interval)
+    start = time.perf_counter()
+    sampler.start()
+    # Everything run on the event loop in the meantime is profiled, not just this task, since it all shares the thread
+    profiler.enable()
+    try:
+        await task
+    finally:
+        profiler.disable()
+        sampler.stop()
+    elapsed = time.perf_counter() - start
+
+    output = StringIO()
+    stats = pstats.Stats(profiler, stream=output)
+    stats.sort_stats('cumulative').print_stats(50)
+    stats.sort_stats('tottime').print_stats(50)
+    return elapsed, output.getvalue(), sampler.collapsed()
+
+
+class LoopWatchdog(threading.Thread):
+    '''Pings the event loop from another thread and calls on_stall(seconds, stack) on the loop when it goes more than
+    `threshold` seconds without answering, with the stack of whatever was blocking it at that point.'''
+
+    def __init__(self, loop, on_stall, threshold=1):
+        super().__init__(daemon=True, name='anzt-watchdog')
+        self.loop = loop
+        self.on_stall = on_stall
+        self.threshold = threshold
+        self.answered = threading.Event()
+        self.stopped = threading.Event()
+        self.stalls = 0
+        # Has to be created from the loop's thread
+        self.loop_thread = threading.get_ident()
+
+    def run(self):
+        while not self.stopped.wait(self.threshold / 2):
+            self.answered.clear()
+            start = time.perf_counter()
+            try:
+                self.loop.call_soon_threadsafe(self.answered.set)
+            except RuntimeError:
+                # The loop was closed
+                return
+            if self.answered.wait(self.threshold):
+                continue
+
+            frame = sys._current_frames().get(self.loop_thread)
+            # Most recent call first so the part that matters survives being cut short
+            stack = ''.join(reversed(traceback.format_stack(frame))) if frame is not None else ''
+            # Report how long it was blocked for in total once it's free to send the report
+            self.answered.wait()
+            self.stalls += 1
+            asyncio.run_coroutine_threadsafe(self.on_stall(time.perf_counter() - start, stack), self.loop)
+
+    def stop(self):
+        self.stopped.set()
+        self.answered.set()
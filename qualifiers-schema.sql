@@ -10,10 +10,12 @@ create table staff (
     staff_discord_id numeric(21)
 );
 
+-- signup_count is kept up to date by toggle_lobby_signup() so it has to be used to change signups
 create table lobbies (
     lobby_id numeric(3) primary key,
     time timestamp,
-    staff_osu_id numeric(13) references staff
+    staff_osu_id numeric(13) references staff,
+    signup_count integer not null default 0 check (signup_count between 0 and 16)
 );
 
 create table lobby_signups (
@@ -21,27 +23,57 @@ create table lobby_signups (
     lobby_id numeric(3) references lobbies
 );
 
+-- A message can show more than one day. See !placeholders
+-- Existing databases: alter table persistent_messages drop constraint persistent_messages_pkey, add unique (day);
 create table persistent_messages (
-    message_id numeric(21) primary key,
-    day date,
+    message_id numeric(21) not null,
+    day date unique,
     thumbnail_url text
 );
 
-create or replace function check_lobby_capacity()
-returns trigger as
+-- Signs a player up to a lobby, moves them to it from another lobby or takes them out of it if they're already in it.
+-- Returns what happened: added, switched, removed, full, no_player or no_lobby.
+-- The player is locked first and then the lobbies in id order, so concurrent calls can't deadlock or overfill a lobby.
+-- Existing databases:
+--   drop trigger tr_check_lobby_capacity on lobby_signups; drop function check_lobby_capacity();
+--   alter table lobbies add signup_count integer not null default 0 check (signup_count between 0 and 16);
+--   update lobbies set signup_count=(select count(*) from lobby_signups where lobby_signups.lobby_id=lobbies.lobby_id);
+create or replace function toggle_lobby_signup(p_osu_id numeric, p_lobby_id numeric)
+returns text as
 $body$
+declare
+    current_lobby numeric;
 begin
-    if (select count(*) from lobby_signups where lobby_id=new.lobby_id) > 15
-    then 
-        raise exception 'lobby is full';
+    perform 1 from players where osu_id=p_osu_id for update;
+    if not found then
+        return 'no_player';
     end if;
-    return new;
+    select lobby_id into current_lobby from lobby_signups where osu_id=p_osu_id;
+
+    perform 1 from lobbies where lobby_id in (p_lobby_id, current_lobby) order by lobby_id for update;
+    if not exists (select 1 from lobbies where lobby_id=p_lobby_id) then
+        return 'no_lobby';
+    end if;
+
+    if current_lobby = p_lobby_id then
+        delete from lobby_signups where osu_id=p_osu_id;
+        update lobbies set signup_count=signup_count-1 where lobby_id=p_lobby_id;
+        return 'removed';
+    end if;
+
+    update lobbies set signup_count=signup_count+1 where lobby_id=p_lobby_id and signup_count < 16;
+    if not found then
+        return 'full';
+    end if;
+    if current_lobby is null then
+        insert into lobby_signups values (p_osu_id, p_lobby_id);
+        return 'added';
+    end if;
+    update lobby_signups set lobby_id=p_lobby_id where osu_id=p_osu_id;
+    update lobbies set signup_count=signup_count-1 where lobby_id=current_lobby;
+    return 'switched';
 end;
 $body$
 language plpgsql;
 
-create trigger tr_check_lobby_capacity
-before insert or update on lobby_signups
-for each row execute procedure check_lobby_capacity();
-
 copy players from '/home/anztbot/players.csv' delimiter ',' csv header;
\ No newline at end of file
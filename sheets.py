@@ -0,0 +1,202 @@
+import asyncio
+import functools
+import random
+import time
+
+import gspread_asyncio
+from gspread.urls import DRIVE_FILES_API_V3_URL
+from gspread.utils import extract_id_from_url
+
+from metrics import registry
+
+
+class SheetsCache:
+    '''Caches spreadsheet and worksheet handles by url and tab for every cog, plus ranges read through values().
+
+    gspread_asyncio already caches handles, but only until it re-authenticates every 45 minutes, and every call it makes
+    waits its turn behind a 1.1 second delay. The handles keep working after re-authenticating so they're kept here instead.
+    Cached ranges are thrown away when the spreadsheet's Drive version changes, which is checked at most once every
+    `version_check_interval` seconds.'''
+    version_check_interval = 30
+
+    def __init__(self, agcm, executor=None):
+        self.agcm = agcm
+        # Where the Drive requests for versions are made from, ResourcesCog's executor. None is the loop's default.
+        self.executor = executor
+        # Spreadsheet id to a task opening it, so concurrent callers share one request
+        self.spreadsheets = {}
+        # (spreadsheet id, tab name) to worksheet handle
+        self.worksheets = {}
+        # Spreadsheet id to (version, {range: values})
+        self.ranges = {}
+        # Spreadsheet id to (version, monotonic time it was checked)
+        self.versions = {}
+        self.hits = 0
+        self.misses = 0
+        self.version_checks = 0
+        self.version_errors = 0
+
+    async def spreadsheet(self, url):
+        '''Returns the handle of the spreadsheet at url, only opening it the first time.'''
+        key = extract_id_from_url(url)
+        task = self.spreadsheets.get(key)
+        if task is None or (task.done() and (task.cancelled() or task.exception() is not None)):
+            task = self.spreadsheets[key] = asyncio.ensure_future(self._open(key))
+        return await asyncio.shield(task)
+
+    async def _open(self, key):
+        agc = await self.agcm.authorize()
+        return await agc.open_by_key(key)
+
+    async def worksheet(self, url, title):
+        '''Returns the handle of a tab of the spreadsheet at url, only looking it up the first time.'''
+        sh = await self.spreadsheet(url)
+        if (sh.id, title) not in self.worksheets:
+            self.worksheets[(sh.id, title)] = await sh.worksheet(title)
+        return self.worksheets[(sh.id, title)]
+
+    async def version(self, key):
+        '''Returns the Drive version of a spreadsheet, which goes up every time it's edited.'''
+        version, checked_at = self.versions.get(key, (None, 0))
+        if time.monotonic() - checked_at > self.version_check_interval:
+            self.version_checks += 1
+            agc = await self.agcm.authorize()
+            # Drive has its own quota so this doesn't need to wait behind the delay agcm puts between sheets calls
+            request = functools.partial(agc.gc.request, 'get', f'{DRIVE_FILES_API_V3_URL}/{key}',
+                                        params={'fields': 'version', 'supportsAllDrives': True})
+            with registry.time('anzt_outbound_seconds', dependency='sheets', operation='drive_version'):
+                response = await asyncio.get_running_loop().run_in_executor(self.executor, request)
+            version = response.json()['version']
+            self.versions[key] = (version, time.monotonic())
+        return version
+
+    async def values(self, sh, ranges, refresh=False):
+        '''Returns the values of each range (like values_batch_get) in one request for those that aren't cached.
+        Only use this for ranges that rarely change, like the mappool or schedule, since edits can take up to
+        version_check_interval seconds to be seen. `refresh` checks the version now instead. If the version can't be checked
+        the ranges are read from the sheet instead, so Drive being unavailable only costs the cache.'''
+        if refresh:
+            self.versions.pop(sh.id, None)
+        try:
+            version = await self.version(sh.id)
+        except Exception:
+            # Without a version there's no telling whether what's cached is current, so read it all from the sheet
+            self.version_errors += 1
+            self.misses += len(ranges)
+            value_ranges = (await sh.values_batch_get(ranges))['valueRanges']
+            return [value_range.get('values', []) for value_range in value_ranges]
+        cached_version, cached = self.ranges.get(sh.id, (None, {}))
+        if cached_version != version:
+            cached = {}
+            self.ranges[sh.id] = (version, cached)
+
+        missing = [cell_range for cell_range in ranges if cell_range not in cached]
+        self.hits += len(ranges) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            value_ranges = (await sh.values_batch_get(missing))['valueRanges']
+            for cell_range, value_range in zip(missing, value_ranges):
+                cached[cell_range] = value_range.get('values', [])
+        return [cached[cell_range] for cell_range in ranges]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0
+        return [f'{len(self.spreadsheets)} spreadsheets, {len(self.worksheets)} worksheets open',
+                f'ranges: {self.hits} hits, {self.misses} misses ({rate:.0%}), {self.version_checks} version checks, {self.version_errors} failed',
+                f'{self.agcm.quota_errors} over quota errors']
+
+
+class QuotaBackoffClientManager(gspread_asyncio.AsyncioGspreadClientManager):
+    '''Backs off exponentially while Google says we're over quota, instead of retrying every 1.1 seconds like the default.
+    Calls are made one at a time so every other sheets call waits out the backoff too.'''
+    max_backoff = 64
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.backoff = 0
+        self.quota_errors = 0
+        self.last_quota_error = 0
+
+    async def _call(self, method, *args, **kwargs):
+        # Includes time spent waiting for a turn, which is usually most of it
+        with registry.time('anzt_outbound_seconds', dependency='sheets', operation=method.__name__):
+            return await super()._call(method, *args, **kwargs)
+
+    async def handle_gspread_error(self, e, method, args, kwargs):
+        if e.response.status_code != 429:
+            return await super().handle_gspread_error(e, method, args, kwargs)
+        self.quota_errors += 1
+        # Quotas are per minute so start again from a short wait if it's been a while since the last time
+        if time.monotonic() - self.last_quota_error > 60:
+            self.backoff = 0
+        self.last_quota_error = time.monotonic()
+        self.backoff = min(self.max_backoff, self.backoff * 2 or 2)
+        await asyncio.sleep(self.backoff * random.uniform(0.5, 1.5))
+
+
+class SheetWriteQueue:
+    '''Collects writes to worksheets and sends them a moment later in as few requests as possible.
+
+    Updates to the same range replace each other so only the last one is sent, every update to a worksheet goes in one
+    batch_update and every appended row goes in one append_rows. Writes are sent `flush_delay` seconds after the first
+    one is queued. Errors are passed to on_error since whoever queued the write has moved on.'''
+    flush_delay = 2
+
+    def __init__(self, on_error):
+        self.on_error = on_error
+        # Worksheet to {'updates': {range: (values, on_written)}, 'appends': [row]}
+        self.pending = {}
+        self.flush_task = None
+        self.queued = 0
+        self.requests = 0
+        self.failed = 0
+
+    def update(self, ws, cell_range, values, on_written=None):
+        '''Queues writing values (a list of rows) to a range of ws, replacing any queued write to the same range.
+        on_written is called with no arguments once the values have been written, and not at all if writing them fails.'''
+        self._pending(ws)['updates'][cell_range] = (values, on_written)
+        self._queued()
+
+    def append(self, ws, row):
+        '''Queues adding a row after the last row of ws.'''
+        self._pending(ws)['appends'].append(row)
+        self._queued()
+
+    def depth(self):
+        return sum(len(writes['updates']) + len(writes['appends']) for writes in self.pending.values())
+
+    def _pending(self, ws):
+        return self.pending.setdefault(ws, {'updates': {}, 'appends': []})
+
+    def _queued(self):
+        self.queued += 1
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_delay)
+        self.flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        '''Sends every queued write now.'''
+        pending, self.pending = self.pending, {}
+        for ws, writes in pending.items():
+            try:
+                if writes['updates']:
+                    self.requests += 1
+                    await ws.batch_update([{'range': cell_range, 'values': values} for cell_range, (values, _) in writes['updates'].items()],
+                                          value_input_option='RAW')
+                    for _, on_written in writes['updates'].values():
+                        if on_written is not None:
+                            on_written()
+                if writes['appends']:
+                    self.requests += 1
+                    await ws.append_rows(writes['appends'], value_input_option='RAW')
+            except Exception:
+                self.failed += len(writes['updates']) + len(writes['appends'])
+                await self.on_error()
+
+    def stats(self):
+        return [f'{self.depth()} writes queued, {self.queued} queued in total, sent in {self.requests} requests, {self.failed} failed']
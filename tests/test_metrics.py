@@ -0,0 +1,105 @@
+'''Checks metrics.py without discord, postgres or the network. Run from the repository's root with `python -m unittest`.'''
+import unittest
+from types import SimpleNamespace
+
+from yarl import URL
+
+from metrics import HttpStats, Registry, registry
+
+
+class RegistryTest(unittest.TestCase):
+    def test_prometheus_text(self):
+        metrics = Registry({'anzt_test_seconds': 'Test timings'})
+        metrics.histogram('anzt_test_seconds', command='report').observe(0.003)
+        metrics.histogram('anzt_test_seconds', command='report').observe(0.2, error=True)
+        metrics.histogram('anzt_test_seconds', command='report').observe(60)
+
+        lines = metrics.prometheus().splitlines()
+        self.assertEqual(lines[0], '# HELP anzt_test_seconds Test timings')
+        self.assertEqual(lines[1], '# TYPE anzt_test_seconds histogram')
+        # Buckets are cumulative and the last one counts everything
+        self.assertIn('anzt_test_seconds_bucket{command="report",le="0.005"} 1', lines)
+        self.assertIn('anzt_test_seconds_bucket{command="report",le="0.1"} 1', lines)
+        self.assertIn('anzt_test_seconds_bucket{command="report",le="0.25"} 2', lines)
+        self.assertIn('anzt_test_seconds_bucket{command="report",le="30"} 2', lines)
+        self.assertIn('anzt_test_seconds_bucket{command="report",le="+Inf"} 3', lines)
+        self.assertIn('anzt_test_seconds_sum{command="report"} 60.203', lines)
+        self.assertIn('anzt_test_seconds_count{command="report"} 3', lines)
+        self.assertIn('# TYPE anzt_test_seconds_errors_total counter', lines)
+        self.assertIn('anzt_test_seconds_errors_total{command="report"} 1', lines)
+
+    def test_labels_are_escaped_and_sorted(self):
+        metrics = Registry({})
+        metrics.histogram('anzt_test_seconds', operation='say "hi"\n', dependency='a\\b').observe(1)
+        self.assertIn('anzt_test_seconds_count{dependency="a\\\\b",operation="say \\"hi\\"\\n"} 1', metrics.prometheus().splitlines())
+
+    def test_same_labels_share_a_histogram(self):
+        metrics = Registry({})
+        self.assertIs(metrics.histogram('anzt_test_seconds', a=1, b=2), metrics.histogram('anzt_test_seconds', b='2', a='1'))
+        self.assertIsNot(metrics.histogram('anzt_test_seconds', a=1), metrics.histogram('anzt_test_seconds', a=2))
+
+    def test_time_counts_errors(self):
+        metrics = Registry({})
+        with self.assertRaises(ValueError):
+            with metrics.time('anzt_test_seconds'):
+                raise ValueError
+        histogram = metrics.histogram('anzt_test_seconds')
+        self.assertEqual((histogram.count, histogram.errors), (1, 1))
+
+    def test_quantile(self):
+        histogram = Registry({}).histogram('anzt_test_seconds')
+        self.assertEqual(histogram.quantile(0.5), 0.0)
+        for _ in range(10):
+            histogram.observe(0.02)
+        # Interpolated within the 0.01 to 0.025 bucket
+        self.assertAlmostEqual(histogram.quantile(0.5), 0.0175)
+
+
+class HttpStatsTest(unittest.IsolatedAsyncioTestCase):
+    '''Calls the trace hooks the way an aiohttp session would, with a made up session and requests.'''
+
+    async def request(self, stats, url, error=False, reused=True):
+        session = object()
+        ctx = SimpleNamespace()
+        params = SimpleNamespace(url=URL(url))
+        await stats._request_start(session, ctx, params)
+        await stats._queued_start(session, ctx, params)
+        await stats._queued_end(session, ctx, params)
+        if reused:
+            await stats._reuseconn(session, ctx, params)
+        else:
+            await stats._dns_miss(session, ctx, params)
+            await stats._create_start(session, ctx, params)
+            await stats._create_end(session, ctx, params)
+        if error:
+            await stats._request_exception(session, ctx, params)
+        else:
+            await stats._request_end(session, ctx, params)
+
+    async def test_trace_hooks(self):
+        stats = HttpStats()
+        outbound = registry.histogram('anzt_outbound_seconds', dependency='osu', operation='/api/v2/users')
+        before = (outbound.count, outbound.errors)
+
+        await self.request(stats, 'https://osu.ppy.sh/api/v2/users?ids[]=2', reused=False)
+        await self.request(stats, 'https://osu.ppy.sh/api/v2/users?ids[]=3')
+        await self.request(stats, 'https://osu.ppy.sh/api/v2/users?ids[]=4', error=True)
+        await self.request(stats, 'https://example.com/webhook')
+
+        self.assertEqual((stats.latency['osu.ppy.sh'].count, stats.latency['osu.ppy.sh'].errors), (3, 1))
+        self.assertEqual(stats.latency['example.com'].count, 1)
+        self.assertEqual((stats.reused, stats.created, stats.dns_misses), (3, 1, 1))
+        self.assertEqual((stats.queued.count, stats.connect.count), (4, 1))
+        # Known hosts are labelled by dependency and path, anything else by host
+        self.assertEqual((outbound.count - before[0], outbound.errors - before[1]), (3, 1))
+        self.assertGreaterEqual(registry.histogram('anzt_outbound_seconds', dependency='example.com', operation='').count, 1)
+        self.assertIn('3/4 requests reused a connection (75%), 0 dns cache hits, 1 misses', stats.stats())
+
+    def test_trace_config(self):
+        config = HttpStats().trace_config()
+        self.assertEqual(len(config.on_request_start), 1)
+        self.assertEqual(len(config.on_dns_cache_miss), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,12 @@
 import asyncio
+import atexit
 import json
+import os
 import re
+import tempfile
+import time
+import traceback
+from types import MappingProxyType
 
 from discord.ext import commands
 
@@ -14,16 +20,103 @@ def res_cog(bot):
 
 
 settings_file = 'settings.jsonc'
+# Minimum seconds between checks of whether the settings file has been edited by hand
+settings_check_interval = 1
+# Seconds to wait after a change before writing the settings file so a burst of !set calls is written once
+settings_write_delay = 2
+# Seconds to wait before trying again after writing the settings file failed
+settings_retry_delay = 30
+# Coroutine function called from inside the except block when writing the settings file fails. Set by ResourcesCog.
+on_settings_write_error = None
+# Executor the settings file is written from. ResourcesCog sets its own so all blocking work shares one managed pool.
+settings_executor = None
+# The parsed settings, a read only snapshot of them for callers, the modification time of the file when it was parsed
+# and when that was last checked
+_data = None
+_settings = None
+_settings_mtime = None
+_settings_checked_at = 0
+# Pending write of _data to the settings file, if there is one. See _schedule_write()
+_write_handle = None
+# Created when first needed since before python 3.10 a lock belongs to the event loop running when it's created
+_write_lock = None
+_dirty = False
+# Counts calls to set_setting() so a write can tell if there were changes while it was happening
+_changes = 0
 
 
-def _get_settings():
+def integer(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError('must be a whole number')
+
+
+def choice(*options):
+    def coerce(value):
+        if value not in options:
+            raise ValueError(f'must be one of {", ".join(options)}')
+        return value
+    return coerce
+
+
+# How to check and convert values given to !set. Exposed settings not in here keep the type of their current value.
+settings_types = {
+    'match-result-posting': {'pool_round': integer},
+    'amplifiers': {'week_number': integer},
+    # Discord ids separated by |. Used to be saved as a number when there was only one.
+    'tourney-signup': {'signups_open': choice('Y', 'N'), 'permitted_foreign_users': str},
+}
+# Exposed setting to the function that converts values for it. Compiled from settings_types when settings are first loaded.
+_schema = None
+
+
+def _compile_schema(data):
+    fallbacks = {int: integer, float: float, str: str}
+    schema = {}
+    for category, values in data.items():
+        for setting, current in values.get('exposed_settings', {}).items():
+            schema[(category, setting)] = settings_types.get(category, {}).get(setting, fallbacks.get(type(current), str))
+    return schema
+
+
+def _freeze(value):
+    '''Recursively converts parsed json into read only mappings and tuples so one copy can be shared by every caller.'''
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def reload_settings():
+    '''Parses the settings file, replacing the snapshot handed out by get_settings().'''
+    global _data, _settings, _settings_mtime, _settings_checked_at, _schema
+    mtime = os.stat(settings_file).st_mtime_ns
     with open(settings_file, 'r') as f:
-        data = json.load(f)
-    return data
+        _data = json.load(f)
+    _settings = _freeze(_data)
+    _settings_mtime = mtime
+    _settings_checked_at = time.monotonic()
+    if _schema is None:
+        _schema = _compile_schema(_data)
+
+
+def get_settings():
+    '''Returns a read only snapshot of every setting, only parsing the file again if it's been modified since last time.'''
+    global _settings_checked_at
+    if _settings is None:
+        reload_settings()
+    # Changes that haven't been written yet would be lost by reloading
+    elif not _dirty and time.monotonic() - _settings_checked_at > settings_check_interval:
+        _settings_checked_at = time.monotonic()
+        if os.stat(settings_file).st_mtime_ns != _settings_mtime:
+            reload_settings()
+    return _settings
 
 
 def get_setting(category, setting=None):
-    data = _get_settings()
+    data = get_settings()
     category = data[category]
     if not setting:
         return category
@@ -32,32 +125,109 @@ def get_setting(category, setting=None):
 
 
 def get_exposed_settings(category):
-    data = _get_settings()
+    data = get_settings()
     category = data[category]
 
     return category['exposed_settings'] if 'exposed_settings' in category else {}
 
 
-def set_setting(category, setting, value, exposed=False):
-    # Convert value to an int if possible
+def _write_settings(text):
+    '''Replaces the settings file with text in one step so a crash can't leave it half written. Returns its new mtime.'''
+    directory = os.path.dirname(os.path.abspath(settings_file))
+    with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp', delete=False) as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    try:
+        os.replace(f.name, settings_file)
+    except OSError:
+        os.remove(f.name)
+        raise
+    return os.stat(settings_file).st_mtime_ns
+
+
+def flush_settings():
+    '''Writes any changed settings to the settings file now.'''
+    global _write_handle, _dirty, _settings_mtime
+    if _write_handle is not None:
+        _write_handle.cancel()
+        _write_handle = None
+    if not _dirty:
+        return
+    _settings_mtime = _write_settings(json.dumps(_data, indent=4))
+    _dirty = False
+
+
+async def _flush_settings_in_thread():
+    '''Writes changed settings from a thread so waiting on the disk doesn't hold up the event loop.'''
+    global _dirty, _settings_mtime, _write_lock
+    if _write_lock is None:
+        _write_lock = asyncio.Lock()
+    # Writes can't overlap or an older one could replace the file last
+    async with _write_lock:
+        changes = _changes
+        text = json.dumps(_data, indent=4)
+        try:
+            _settings_mtime = await asyncio.get_running_loop().run_in_executor(settings_executor, _write_settings, text)
+        except Exception:
+            # Still dirty so try again later, e.g. once there's space on the disk
+            _retry_write()
+            if on_settings_write_error is not None:
+                await on_settings_write_error()
+            else:
+                traceback.print_exc()
+            return
+        # Anything changed while writing has scheduled another write
+        if changes == _changes:
+            _dirty = False
+
+
+def _retry_write():
+    global _write_handle
+    if _write_handle is None:
+        _write_handle = asyncio.get_running_loop().call_later(settings_retry_delay, _start_write)
+
+
+def _start_write():
+    global _write_handle
+    _write_handle = None
+    asyncio.ensure_future(_flush_settings_in_thread())
+
+
+def _schedule_write():
+    global _write_handle, _dirty, _changes
+    _dirty = True
+    _changes += 1
     try:
-        value = int(value)
-    except ValueError:
-        pass
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # Nothing to write later with, e.g. when called from a script
+        flush_settings()
+        return
+    if _write_handle is None:
+        _write_handle = loop.call_later(settings_write_delay, _start_write)
+
 
-    data = _get_settings()
+# Don't lose changes still waiting to be written when the bot is stopped
+atexit.register(flush_settings)
 
+
+def set_setting(category, setting, value, exposed=False):
+    '''Changes a setting straight away and writes it to the settings file shortly after.
+    Values for exposed settings are converted with settings_types, raising ValueError if they aren't valid.'''
+    global _settings
+    get_settings()
     if exposed:
-        data[category]['exposed_settings'][setting] = value
+        value = _schema.get((category, setting), str)(value)
+        _data[category]['exposed_settings'][setting] = value
     else:
-        data[category][setting] = value
-
-    with open(settings_file, 'w') as f:
-        json.dump(data, f, indent=4)
+        _data[category][setting] = value
+    _settings = _freeze(_data)
+    _schedule_write()
 
 
 def set_exposed_setting(category, setting, value):
-    exposed_settings = get_exposed_settings(category)
+    exposed_settings = get_exposed_settings(category) if category in get_settings() else {}
     if setting in exposed_settings:
         set_setting(category, setting, value, exposed=True)
         return True
@@ -81,14 +251,20 @@ def url_to_id(url: str) -> int:
         raise SyntaxError("\"{}\" is not a valid mp link".format(url))
 
 
-async def request(url: str, bot, headers: dict = {}) -> dict:
-    '''Quick and dirty short-hand REST API grabber.'''
-    session = await res_cog(bot).session()
-    async with session.get(url, headers=headers) as r:
-        if r.status != 200:
-            raise Exception('External server returned status code other than 200')
-        json = await r.json()
-    return json
+def sheet_range(tab: str, cells: str) -> str:
+    '''Qualifies a range of cells with the name of the tab they're on so it can be used in spreadsheet level requests.'''
+    tab = tab.replace("'", "''")
+    return f"'{tab}'!{cells}"
+
+
+async def gather_limited(coros, limit):
+    '''Like asyncio.gather() but only runs up to `limit` of the coroutines at once.'''
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+    return await asyncio.gather(*[run(coro) for coro in coros])
 
 
 async def confirm(prompt, ctx, timeout=20.0):